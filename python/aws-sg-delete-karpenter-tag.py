@@ -4,10 +4,17 @@
 #   Input arg1: aws region
 #   Input arg2: tag suffix for environment to query, ex. dev-ue2
 #   Input arg3: node group name, ex. core
+#
+#   Or --manifest <file> with one "region tag_suffix node_group_name" target per line
+#   to clean up many clusters/node groups at once, all regions run concurrently
+#
+#   --tagging-api finds and untags the groups with the Resource Groups Tagging API
+#   instead of describing security groups (groups are matched by their Name tag)
 
 import boto3
 import sys
 from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
 import argparse
 import os
 
@@ -21,24 +28,65 @@ if not cur_version >= req_version:
 
 script_name = os.path.basename(__file__)
 
+# Number of security group ids passed to each delete_tags call
+delete_tags_batch_size = 200
+
+# untag_resources accepts at most 20 ARNs per call
+untag_resources_batch_size = 20
+
+# Max number of regions processed at the same time in manifest mode
+max_region_workers = 8
+
 # Get cli arguments
 parser = argparse.ArgumentParser(description="Delete a specific tag from security groups")
-parser.add_argument("region", help="AWS Region", type=str)
-parser.add_argument("tag_suffix", help="AWS Tag Suffix", type=str)
-parser.add_argument("node_group_name", help="EKS Node Group Name", type=str)
+parser.add_argument("region", help="AWS Region", type=str, nargs='?')
+parser.add_argument("tag_suffix", help="AWS Tag Suffix", type=str, nargs='?')
+parser.add_argument("node_group_name", help="EKS Node Group Name", type=str, nargs='?')
+parser.add_argument("--manifest", help="File with one 'region tag_suffix node_group_name' target per line", type=str)
+parser.add_argument("--tagging-api", help="Use the Resource Groups Tagging API to find and untag the groups", action="store_true")
 parser.add_argument("--awsprofile", help="AWS Profile name", type=str)
 args = parser.parse_args()
-region = args.region
-tag_suffix = args.tag_suffix
-node_group_name = args.node_group_name
 if args.awsprofile:
     aws_profile = args.awsprofile
 
+# Build the list of (region, tag_suffix, node_group_name) targets
+targets = []
+if args.manifest:
+    try:
+        with open(args.manifest) as file:
+            for line_number, line in enumerate(file, 1):
+                line = line.split('#', 1)[0].strip()
+                if line == '':
+                    continue
+                fields = line.split()
+                if len(fields) != 3:
+                    print(f'Error: {args.manifest} line {line_number}: expected "region tag_suffix node_group_name"')
+                    exit(2)
+                targets.append(tuple(fields))
+    except OSError as error:
+        print(f'Error: {error}')
+        exit(2)
+    if len(targets) == 0:
+        print(f'Error: {args.manifest} has no "region tag_suffix node_group_name" targets')
+        exit(2)
+elif args.region and args.tag_suffix and args.node_group_name:
+    targets.append((args.region, args.tag_suffix, args.node_group_name))
+else:
+    parser.error('region, tag_suffix and node_group_name are required unless --manifest is given')
+# Drop duplicate targets but keep the order they were given in
+targets = list(dict.fromkeys(targets))
+
 # Show script supplied arguments
 print(f'Starting {script_name} script')
-print(f'Region: {region}')
-print(f'Tag suffix: {tag_suffix}')
-print(f'Node group name: {node_group_name}')
+if args.manifest:
+    print(f'Manifest: {args.manifest} ({len(targets)} targets)')
+else:
+    region, tag_suffix, node_group_name = targets[0]
+    print(f'Region: {region}')
+    print(f'Tag suffix: {tag_suffix}')
+    print(f'Node group name: {node_group_name}')
+if args.tagging_api:
+    print('Using the Resource Groups Tagging API')
 if args.awsprofile:
     print(f'Using AWS Profile: {aws_profile}')
 
@@ -50,56 +98,200 @@ if args.awsprofile:
         print(f'Error: {error}')
         exit(2)
 
-my_config = Config(
-    region_name = region,
-    signature_version = 'v4',
-    retries = {
-        'max_attempts': 3,
-        'mode': 'standard'
-    }
-)
 
-try:
-    client = boto3.client('ec2', config=my_config)
-except Exception as error:
-    print(f'Error: {error}')
-    exit(2)
+def get_client(region, service):
+    my_config = Config(
+        region_name = region,
+        signature_version = 'v4',
+        retries = {
+            'max_attempts': 3,
+            'mode': 'standard'
+        }
+    )
+    return boto3.client(service, config=my_config)
+
+
+def find_security_groups(client, region_targets):
+    """ Fetch the candidate groups for all of a region's targets in one paginated, filtered query
+        and return {target: {group_id: group_name}} """
+    security_groups = []
+    paginator = client.get_paginator('describe_security_groups')
+    for page in paginator.paginate(
+        Filters=[
+            {
+                'Name': 'group-name',
+                'Values': sorted({f'{node_group_name}-eks-{tag_suffix}*' for region, tag_suffix, node_group_name in region_targets})
+            },
+            {
+                'Name': 'tag:karpenter.sh/discovery',
+                'Values': sorted({f'eks-{tag_suffix}' for region, tag_suffix, node_group_name in region_targets})
+            },
+        ]
+    ):
+        security_groups.extend(page['SecurityGroups'])
+    print(f'{region_targets[0][0]}: retrieved {len(security_groups)} candidate security groups')
+
+    matches = {target: {} for target in region_targets}
+    for group in security_groups:
+        tags = {tag['Key']: tag['Value'] for tag in group.get('Tags', [])}
+        for target in region_targets:
+            region, tag_suffix, node_group_name = target
+            # core-eks-staging-ue2-20220731234231387900000001
+            if group['GroupName'].startswith(f'{node_group_name}-eks-{tag_suffix}') and tags.get('karpenter.sh/discovery') == f'eks-{tag_suffix}':
+                matches[target][group['GroupId']] = group['GroupName']
+    return matches
 
-group_name = f'{node_group_name}-eks-{tag_suffix}'
 
+def find_tagged_security_groups(client, region_targets):
+    """ Find the groups carrying any of the region's karpenter tag values with get_resources,
+        returns ({target: {group_id: group_name}}, {group_id: arn}) """
+    resources = []
+    paginator = client.get_paginator('get_resources')
+    for page in paginator.paginate(
+        TagFilters=[
+            {
+                'Key': 'karpenter.sh/discovery',
+                'Values': sorted({f'eks-{tag_suffix}' for region, tag_suffix, node_group_name in region_targets})
+            },
+        ],
+        ResourceTypeFilters=['ec2:security-group']
+    ):
+        resources.extend(page['ResourceTagMappingList'])
+    print(f'{region_targets[0][0]}: retrieved {len(resources)} tagged security groups')
+
+    matches = {target: {} for target in region_targets}
+    arns = {}
+    for resource in resources:
+        # arn:aws:ec2:us-east-2:123456789012:security-group/sg-0123456789abcdef0
+        security_group_id = resource['ResourceARN'].split('/')[-1]
+        tags = {tag['Key']: tag['Value'] for tag in resource['Tags']}
+        # The tagging API does not return the group name, so the node group is matched on the Name tag
+        if 'Name' not in tags:
+            print(f'Skipping security group {security_group_id}, it has no Name tag to match a node group on')
+            continue
+        for target in region_targets:
+            region, tag_suffix, node_group_name = target
+            if tags['Name'].startswith(f'{node_group_name}-eks-{tag_suffix}') and tags['karpenter.sh/discovery'] == f'eks-{tag_suffix}':
+                matches[target][security_group_id] = tags['Name']
+                arns[security_group_id] = resource['ResourceARN']
+    return matches, arns
+
+
+def untag_karpenter_tag(client, arns):
+    """ Remove the tag with untag_resources, 20 ARNs per call, returns {group_id: result} """
+    results = {}
+    group_ids = sorted(arns)
+    for i in range(0, len(group_ids), untag_resources_batch_size):
+        batch = group_ids[i:i + untag_resources_batch_size]
+        try:
+            response = client.untag_resources(
+                ResourceARNList=[arns[security_group_id] for security_group_id in batch],
+                TagKeys=['karpenter.sh/discovery']
+            )
+        except Exception as error:
+            for security_group_id in batch:
+                results[security_group_id] = f'Error: {error}'
+            continue
+        failed_resources = response.get('FailedResourcesMap', {})
+        for security_group_id in batch:
+            failure = failed_resources.get(arns[security_group_id])
+            if failure is None:
+                results[security_group_id] = 'deleted'
+            else:
+                results[security_group_id] = f'Error: {failure.get("ErrorCode")} {failure.get("ErrorMessage")}'
+    return results
+
+
+def delete_karpenter_tag(client, cluster_name, group_ids):
+    """ Remove the tag from many groups per delete_tags call, a failed batch is retried
+        one group at a time so each group gets its own result """
+    karpenter_tag = [
+        {
+            'Key': 'karpenter.sh/discovery',
+            'Value': cluster_name
+        },
+    ]
+    results = {}
+    for i in range(0, len(group_ids), delete_tags_batch_size):
+        batch = group_ids[i:i + delete_tags_batch_size]
+        try:
+            client.delete_tags(DryRun=False, Resources=batch, Tags=karpenter_tag)
+            for security_group_id in batch:
+                results[security_group_id] = 'deleted'
+        except Exception as error:
+            print(f'Batch delete failed, retrying groups individually. Error: {error}')
+            for security_group_id in batch:
+                try:
+                    client.delete_tags(DryRun=False, Resources=[security_group_id], Tags=karpenter_tag)
+                    results[security_group_id] = 'deleted'
+                except Exception as error:
+                    results[security_group_id] = f'Error: {error}'
+    return results
+
+
+def process_region(client, region_targets):
+    """ Find and untag every target's groups in one region, returns a list of
+        (region, tag_suffix, node_group_name, group_name, group_id, result) rows """
+    try:
+        if args.tagging_api:
+            matches, arns = find_tagged_security_groups(client, region_targets)
+        else:
+            matches = find_security_groups(client, region_targets)
+    except Exception as error:
+        return [(*target, None, None, f'Error: {error}') for target in region_targets]
+
+    # delete_tags matches on the tag value, so batch the groups per cluster name
+    groups_by_cluster = {}
+    for (region, tag_suffix, node_group_name), groups in matches.items():
+        for security_group_id, security_group_name in groups.items():
+            print(f'Found security group {security_group_name} to remove karpenter tag from')
+            groups_by_cluster.setdefault(f'eks-{tag_suffix}', set()).add(security_group_id)
+    if args.tagging_api:
+        results = untag_karpenter_tag(client, arns)
+    else:
+        results = {}
+        for cluster_name, group_ids in groups_by_cluster.items():
+            results.update(delete_karpenter_tag(client, cluster_name, sorted(group_ids)))
+
+    rows = []
+    for target in region_targets:
+        if len(matches[target]) == 0:
+            rows.append((*target, None, None, 'not found'))
+        for security_group_id, security_group_name in sorted(matches[target].items()):
+            rows.append((*target, security_group_name, security_group_id, results[security_group_id]))
+    return rows
+
+
+# One pooled client per region, created up front since client creation is not thread safe
+targets_by_region = {}
+for target in targets:
+    targets_by_region.setdefault(target[0], []).append(target)
 try:
-    response = client.describe_security_groups()
+    service = 'resourcegroupstaggingapi' if args.tagging_api else 'ec2'
+    clients = {region: get_client(region, service) for region in targets_by_region}
 except Exception as error:
     print(f'Error: {error}')
     exit(2)
 
-num_of_sgs = len(response['SecurityGroups'])
-print(f'Retrieved {num_of_sgs} total security groups')
-
-for group in response['SecurityGroups']:
-    #print(group_name) # core-eks-staging-ue2
-    if group['GroupName'].startswith(group_name):
-        # core-eks-staging-ue2-20220731234231387900000001
-        print(f'Found security group {group["GroupName"]} to remove karpenter tag from')
-        security_group_name = group['GroupName']
-        security_group_id = group['GroupId']
-        cluster_name = f'eks-{tag_suffix}'
-        try:
-            response = client.delete_tags(
-                DryRun=False,
-                Resources=[
-                    security_group_id,
-                ],
-                Tags=[
-                    {
-                        'Key': 'karpenter.sh/discovery',
-                        'Value': cluster_name
-                    },
-                ]
-            )
-            print(f'Successfully deleted tag from security group: {security_group_name}')
-            exit(0)
-        except Exception as error:
-            print(f'Error: {error}')
-            exit(2)
-print('Did not find security group to remove karpenter tag from')        
+with ThreadPoolExecutor(max_workers=min(max_region_workers, len(targets_by_region))) as executor:
+    futures = [executor.submit(process_region, clients[region], region_targets) for region, region_targets in targets_by_region.items()]
+    rows = [row for future in futures for row in future.result()]
+
+# Consolidated summary
+print('')
+deleted = failed = not_found = 0
+for region, tag_suffix, node_group_name, security_group_name, security_group_id, result in rows:
+    if result == 'deleted':
+        deleted += 1
+        print(f'Successfully deleted tag from security group: {security_group_name} ({security_group_id}) [{region} {tag_suffix} {node_group_name}]')
+    elif result == 'not found':
+        not_found += 1
+        print(f'Did not find security group to remove karpenter tag from [{region} {tag_suffix} {node_group_name}]')
+    else:
+        failed += 1
+        print(f'Failed to delete tag from security group: {security_group_name} ({security_group_id}) [{region} {tag_suffix} {node_group_name}] {result}')
+
+print(f'Deleted tag from {deleted} security groups, {failed} failed, {not_found} targets without a matching group')
+if failed > 0:
+    exit(2)
+exit(0)
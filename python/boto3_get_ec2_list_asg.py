@@ -1,36 +1,276 @@
+import os
 import sys
+import time
+import json
+import hashlib
+import argparse
+from multiprocessing.pool import ThreadPool
 import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+
+default_region = 'us-east-1'
+
+# describe_auto_scaling_groups accepts at most 100 names per call
+asg_batch_size = 100
+# Number of instance ids passed to each describe_instances call
+instance_batch_size = 100
+# Lookups are cached here for --cache-ttl seconds (default 60 for the Ansible --list/--host inventory mode)
+cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "boto3_get_ec2_list_asg")
+inventory_cache_ttl = 60
+# --watch polls every --interval seconds, doubling the wait on API errors up to this many seconds
+watch_max_backoff = 300
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def get_asg_instance_ids(asg_client, asg_names):
+    """ Return a dict of asg name -> list of instance-ids, batching up to 100 names per call """
+    asg_instance_ids = {}
+    paginator = asg_client.get_paginator('describe_auto_scaling_groups')
+    for asg_batch in chunks(asg_names, asg_batch_size):
+        for page in paginator.paginate(AutoScalingGroupNames=asg_batch):
+            for i in page['AutoScalingGroups']:
+                asg_instance_ids[i['AutoScalingGroupName']] = [k['InstanceId'] for k in i['Instances']]
+    return asg_instance_ids
+
+
+def get_asg_instance_ids_by_tags(asg_client, tag_filters):
+    """ Return a dict of asg name -> list of instance-ids for the ASGs matching the tag filters (server-side) """
+    asg_instance_ids = {}
+    paginator = asg_client.get_paginator('describe_auto_scaling_groups')
+    for page in paginator.paginate(Filters=tag_filters):
+        for i in page['AutoScalingGroups']:
+            asg_instance_ids[i['AutoScalingGroupName']] = [k['InstanceId'] for k in i['Instances']]
+    return asg_instance_ids
+
+
+def get_tag_filters(tags):
+    """ Turn 'key=value' (or bare 'key') selectors into describe_auto_scaling_groups Filters """
+    tag_filters = []
+    for tag in tags:
+        if '=' in tag:
+            key, value = tag.split('=', 1)
+            tag_filters.append({'Name': 'tag:%s' % key, 'Values': value.split(',')})
+        else:
+            tag_filters.append({'Name': 'tag-key', 'Values': [tag]})
+    return tag_filters
+
+
+def get_private_ips(ec2_client, instance_ids):
+    """ Return a dict of instance-id -> private ip, with paginated describe_instances calls in chunks """
+    private_ips = {}
+    paginator = ec2_client.get_paginator('describe_instances')
+    for instance_batch in chunks(instance_ids, instance_batch_size):
+        for page in paginator.paginate(InstanceIds=instance_batch):
+            for instances in page['Reservations']:
+                for ip in instances['Instances']:
+                    if 'PrivateIpAddress' in ip:
+                        private_ips[ip['InstanceId']] = ip['PrivateIpAddress']
+    return private_ips
+
+
+def lookup_members(asg_client, ec2_client, asg_names, tags):
+    """ Return (asg names, asg name -> instance-ids, instance-id -> private ip) for the named or tagged ASGs """
+    if len(tags) > 0:
+        asg_instance_ids = get_asg_instance_ids_by_tags(asg_client, get_tag_filters(tags))
+        asg_names = sorted(asg_instance_ids)
+    else:
+        asg_instance_ids = get_asg_instance_ids(asg_client, asg_names)
+
+    instance_ids = [] # List of instance-ids across all ASGs
+    for asg in asg_names:
+        instance_ids.extend(asg_instance_ids.get(asg, []))
+
+    return asg_names, asg_instance_ids, get_private_ips(ec2_client, instance_ids)
+
+
+def lookup_regions(pool, clients, asg_names, tags):
+    """ Run lookup_members for every region at once, returns region -> {asg_names, asg_instance_ids, private_ips} """
+    def lookup_region(region):
+        asg_client, ec2_client = clients[region]
+        region_asg_names, asg_instance_ids, private_ips = lookup_members(asg_client, ec2_client, asg_names, tags)
+        return region, {'asg_names': region_asg_names, 'asg_instance_ids': asg_instance_ids, 'private_ips': private_ips}
+    return dict(pool.map(lookup_region, sorted(clients)))
 
-if len(sys.argv) == 1:
-    print "Missing required argument -- asg name"
-    quit(2)
 
-asg = sys.argv[1]
+def watch_members(pool, clients, asg_names, tags, interval):
+    """ Poll the ASGs forever and print an NDJSON event for each instance that joins or leaves """
+    members = set()
+    wait = interval
+    while True:
+        try:
+            lookups = lookup_regions(pool, clients, asg_names, tags)
+        except (BotoCoreError, ClientError) as error:
+            wait = min(wait * 2, watch_max_backoff)
+            sys.stderr.write("Error: %s (retrying in %ss)\n" % (error, wait))
+            time.sleep(wait)
+            continue
+        wait = interval
+        current = set()
+        for region, lookup in lookups.items():
+            for asg in lookup['asg_names']:
+                for k in lookup['asg_instance_ids'].get(asg, []):
+                    if k in lookup['private_ips']:
+                        current.add((region, asg, k, lookup['private_ips'][k]))
+        event_time = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        for event, changed in (('removed', members - current), ('added', current - members)):
+            for region, asg, k, ip in sorted(changed):
+                print json.dumps({'event': event, 'time': event_time, 'region': region, 'asg_name': asg, 'instance_id': k, 'private_ip': ip})
+        sys.stdout.flush()
+        members = current
+        time.sleep(interval)
 
-asg_client = boto3.client('autoscaling', region_name='us-east-1')
-ec2_client = boto3.client('ec2', region_name='us-east-1')
 
-asg_response = asg_client.describe_auto_scaling_groups(AutoScalingGroupNames=[asg])
+def get_cache_file(regions, asg_names, tags):
+    """ Cache file for this set of regions and ASG names/tags (order does not matter) """
+    cache_key = json.dumps([sorted(regions), sorted(asg_names), sorted(tags)])
+    return os.path.join(cache_dir, "%s.json" % hashlib.sha1(cache_key.encode('utf-8')).hexdigest())
 
-instance_ids = [] # List of instance-ids
 
-if len(asg_response['AutoScalingGroups']) > 0:
-    for i in asg_response['AutoScalingGroups']:
-        for k in i['Instances']:
-            instance_ids.append(k['InstanceId'])
+def read_cache(cache_file, ttl):
+    """ Return the cached lookup if it is younger than ttl seconds, else None """
+    if ttl <= 0:
+        return None
+    try:
+        if time.time() - os.path.getmtime(cache_file) > ttl:
+            return None
+        with open(cache_file) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_cache(cache_file, lookup):
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # Write then rename so a concurrent reader never sees a partial file
+    tmp_file = "%s.%s.tmp" % (cache_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(lookup, f)
+    os.rename(tmp_file, cache_file)
+
+
+def get_inventory(lookups):
+    """ Ansible dynamic inventory, one group per ASG (across regions) with the private IPs as hosts """
+    inventory = {'_meta': {'hostvars': {}}}
+    for region in sorted(lookups):
+        lookup = lookups[region]
+        for asg in lookup['asg_names']:
+            hosts = inventory.setdefault(asg, {'hosts': []})['hosts']
+            for k in lookup['asg_instance_ids'].get(asg, []):
+                if k in lookup['private_ips']:
+                    hosts.append(lookup['private_ips'][k])
+                    inventory['_meta']['hostvars'][lookup['private_ips'][k]] = {'asg_name': asg, 'instance_id': k, 'aws_region': region}
+    return inventory
+
+
+parser = argparse.ArgumentParser(description="Print the private IPs of the instances in one or more autoscale groups")
+parser.add_argument("asg", nargs="*", help="Autoscale group name(s), read from stdin if none given (or '-')")
+parser.add_argument("-t", "--tag", action="append", default=[], help="Select ASGs by tag instead of name, 'key=value[,value]' or 'key' (repeat to AND)")
+parser.add_argument("-r", "--regions", type=str, help="Comma separated AWS regions to look in, queried concurrently (default: %s)" % default_region)
+parser.add_argument("--list", action="store_true", help="Print an Ansible dynamic inventory grouped by ASG (names/tags from ASG_NAMES/ASG_TAGS if not given)")
+parser.add_argument("--host", type=str, help="Print the Ansible inventory variables for a host")
+parser.add_argument("--watch", action="store_true", help="Keep polling and print added/removed instances as NDJSON events")
+parser.add_argument("--interval", type=int, default=15, help="Seconds between --watch polls (default: 15)")
+parser.add_argument("--cache-ttl", type=int, help="Seconds to reuse a cached lookup for (default: 0, or %s with --list/--host)" % inventory_cache_ttl)
+args = parser.parse_args()
+
+inventory_mode = args.list or args.host is not None
+if args.cache_ttl is not None:
+    cache_ttl = args.cache_ttl
+elif inventory_mode:
+    cache_ttl = int(os.environ.get('ASG_INVENTORY_CACHE_TTL', inventory_cache_ttl))
 else:
-    print "Autoscale group name '%s' not found! Exiting script" % asg
+    cache_ttl = 0
+
+if args.regions is not None:
+    regions = args.regions
+elif inventory_mode:
+    regions = os.environ.get('ASG_REGIONS', default_region)
+else:
+    regions = default_region
+regions = sorted(set(r.strip() for r in regions.split(',') if r.strip() != ''))
+
+# Ansible runs inventory scripts with only --list/--host, so names and tags can come from the environment
+asg_names = args.asg
+if inventory_mode and len(asg_names) == 0 and len(args.tag) == 0:
+    asg_names = os.environ.get('ASG_NAMES', '').replace(',', ' ').split()
+    args.tag = os.environ.get('ASG_TAGS', '').split()
+    if len(asg_names) == 0 and len(args.tag) == 0:
+        print "Inventory mode needs ASG names or tags (ASG_NAMES / ASG_TAGS environment variables)"
+        quit(2)
+
+# ASG names come from the command line, or one per line on stdin if none given (or '-')
+if len(args.tag) == 0 and (len(asg_names) == 0 or asg_names == ['-']):
+    if sys.stdin.isatty():
+        print "Missing required argument -- asg name"
+        quit(2)
+    asg_names = sys.stdin.read().split()
+if len(args.tag) == 0 and len(asg_names) == 0:
+    print "Missing required argument -- asg name"
     quit(2)
+# Drop duplicate names but keep the order they were given in
+asg_names = [asg for i, asg in enumerate(asg_names) if asg not in asg_names[:i]]
 
-ec2_response = ec2_client.describe_instances(
-    InstanceIds = instance_ids
-    )   
 
-if len(ec2_response['Reservations']) > 0:
-    private_ip = [] # List to hold the Private IP Address
-    for instances in ec2_response['Reservations']:
-        for ip in instances['Instances']:
-            private_ip.append(ip['PrivateIpAddress'])
-    print "\n".join(private_ip)
-else:
-    print "No instances found in autoscale group '%s'" % asg
+def get_clients():
+    """ One autoscaling/ec2 client pair per region, created up front since creating clients is not thread safe """
+    return dict((r, (boto3.client('autoscaling', region_name=r), boto3.client('ec2', region_name=r))) for r in regions)
+
+
+if args.watch:
+    # The clients and threads are created once and reused for every poll
+    pool = ThreadPool(len(regions))
+    try:
+        watch_members(pool, get_clients(), asg_names, args.tag, args.interval)
+    except KeyboardInterrupt:
+        quit(0)
+
+cache_file = get_cache_file(regions, asg_names, args.tag)
+lookups = read_cache(cache_file, cache_ttl)
+if lookups is None:
+    # Regions are looked up in parallel, so the wall time is that of the slowest region
+    pool = ThreadPool(len(regions))
+    lookups = lookup_regions(pool, get_clients(), asg_names, args.tag)
+    pool.close()
+    if cache_ttl > 0:
+        write_cache(cache_file, lookups)
+
+if len(args.tag) > 0 and not inventory_mode:
+    asg_names = sorted(set(asg for lookup in lookups.values() for asg in lookup['asg_names']))
+    if len(asg_names) == 0:
+        print "No autoscale groups found matching tags %s" % ", ".join(args.tag)
+        quit(2)
+
+if inventory_mode:
+    inventory = get_inventory(lookups)
+    if args.host is not None:
+        print json.dumps(inventory['_meta']['hostvars'].get(args.host, {}), indent=2)
+    else:
+        print json.dumps(inventory, indent=2)
+    quit(0)
+
+exit_code = 0
+for asg in asg_names:
+    found_regions = [r for r in regions if asg in lookups[r]['asg_instance_ids']]
+    if len(found_regions) == 0:
+        print "Autoscale group name '%s' not found!" % asg
+        exit_code = 2
+        continue
+    for region in found_regions:
+        asg_instance_ids, private_ips = lookups[region]['asg_instance_ids'], lookups[region]['private_ips']
+        private_ip = [private_ips[k] for k in asg_instance_ids[asg] if k in private_ips] # List to hold the Private IP Address
+        if len(private_ip) == 0:
+            print "No instances found in autoscale group '%s' (%s)" % (asg, region)
+        elif len(regions) > 1:
+            for ip in private_ip:
+                print "%s\t%s\t%s" % (region, asg, ip)
+        elif len(asg_names) == 1 and len(args.tag) == 0:
+            print "\n".join(private_ip)
+        else:
+            for ip in private_ip:
+                print "%s\t%s" % (asg, ip)
+quit(exit_code)
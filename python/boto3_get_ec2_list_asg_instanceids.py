@@ -1,30 +1,172 @@
+import os
 import sys
+import time
+import json
+import hashlib
+import argparse
+from multiprocessing.pool import ThreadPool
 import boto3
 
-if len(sys.argv) == 1:
-    print "Missing required argument -- asg name"
-    quit(2)
+default_region = 'us-east-1'
+
+# describe_auto_scaling_groups accepts at most 100 names per call
+asg_batch_size = 100
+# Lookups are cached here for --cache-ttl seconds (default 60 for the Ansible --list/--host inventory mode)
+cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "boto3_get_ec2_list_asg_instanceids")
+inventory_cache_ttl = 60
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def get_asg_instance_ids(asg_client, asg_names, lifecycle_states, health_statuses):
+    """ Return a dict of asg name -> list of instance-ids, keeping only instances in the given states """
+    asg_instance_ids = {}
+    paginator = asg_client.get_paginator('describe_auto_scaling_groups')
+    for asg_batch in chunks(asg_names, asg_batch_size):
+        for page in paginator.paginate(AutoScalingGroupNames=asg_batch):
+            for i in page['AutoScalingGroups']:
+                asg_instance_ids[i['AutoScalingGroupName']] = [
+                    k['InstanceId'] for k in i['Instances']
+                    if (len(lifecycle_states) == 0 or k['LifecycleState'] in lifecycle_states)
+                    and (len(health_statuses) == 0 or k['HealthStatus'] in health_statuses)]
+    return asg_instance_ids
+
+
+def get_cache_file(regions, asg_names, lifecycle_states, health_statuses):
+    """ Cache file for this set of regions, ASG names and state filters (order does not matter) """
+    cache_key = json.dumps([sorted(regions), sorted(asg_names), sorted(lifecycle_states), sorted(health_statuses)])
+    return os.path.join(cache_dir, "%s.json" % hashlib.sha1(cache_key.encode('utf-8')).hexdigest())
+
+
+def read_cache(cache_file, ttl):
+    """ Return the cached lookup if it is younger than ttl seconds, else None """
+    if ttl <= 0:
+        return None
+    try:
+        if time.time() - os.path.getmtime(cache_file) > ttl:
+            return None
+        with open(cache_file) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
 
-asg = sys.argv[1]
+def write_cache(cache_file, lookup):
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # Write then rename so a concurrent reader never sees a partial file
+    tmp_file = "%s.%s.tmp" % (cache_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(lookup, f)
+    os.rename(tmp_file, cache_file)
 
-asg_client = boto3.client('autoscaling', region_name='us-east-1')
-ec2_client = boto3.client('ec2', region_name='us-east-1')
 
-asg_response = asg_client.describe_auto_scaling_groups(AutoScalingGroupNames=[asg])
+def get_inventory(asg_names, lookups):
+    """ Ansible dynamic inventory, one group per ASG (across regions) with the instance-ids as hosts (ex. for the aws_ssm connection) """
+    inventory = {'_meta': {'hostvars': {}}}
+    for region in sorted(lookups):
+        for asg in asg_names:
+            hosts = inventory.setdefault(asg, {'hosts': []})['hosts']
+            for k in lookups[region].get(asg, []):
+                hosts.append(k)
+                inventory['_meta']['hostvars'][k] = {'asg_name': asg, 'instance_id': k, 'aws_region': region}
+    return inventory
 
-instance_ids = [] # List of instance-ids
 
-if len(asg_response['AutoScalingGroups']) > 0:
-    for i in asg_response['AutoScalingGroups']:
-        for k in i['Instances']:
-            instance_ids.append(k['InstanceId'])
+parser = argparse.ArgumentParser(description="Print the instance-ids of the instances in one or more autoscale groups")
+parser.add_argument("asg", nargs="*", help="Autoscale group name(s), read from stdin if none given (or '-')")
+parser.add_argument("-s", "--lifecycle-state", action="append", default=[], help="Only list instances in this lifecycle state, ex. InService (repeat for more)")
+parser.add_argument("-H", "--health-status", action="append", default=[], choices=["Healthy", "Unhealthy"], help="Only list instances with this health status")
+parser.add_argument("-r", "--regions", type=str, help="Comma separated AWS regions to look in, queried concurrently (default: %s)" % default_region)
+parser.add_argument("--list", action="store_true", help="Print an Ansible dynamic inventory grouped by ASG (names from ASG_NAMES if not given)")
+parser.add_argument("--host", type=str, help="Print the Ansible inventory variables for a host")
+parser.add_argument("--cache-ttl", type=int, help="Seconds to reuse a cached lookup for (default: 0, or %s with --list/--host)" % inventory_cache_ttl)
+args = parser.parse_args()
+
+inventory_mode = args.list or args.host is not None
+if args.cache_ttl is not None:
+    cache_ttl = args.cache_ttl
+elif inventory_mode:
+    cache_ttl = int(os.environ.get('ASG_INVENTORY_CACHE_TTL', inventory_cache_ttl))
 else:
-    print "Autoscale group name '%s' not found! Exiting script" % asg
-    quit(2)
+    cache_ttl = 0
 
-if len(instance_ids) > 0:
-    for x in instance_ids:
-        print x,
+if args.regions is not None:
+    regions = args.regions
+elif inventory_mode:
+    regions = os.environ.get('ASG_REGIONS', default_region)
 else:
-    print "No instances found in ASG! Exiting script"
+    regions = default_region
+regions = sorted(set(r.strip() for r in regions.split(',') if r.strip() != ''))
+
+# Ansible runs inventory scripts with only --list/--host, so names can come from the environment
+asg_names = args.asg
+if inventory_mode and len(asg_names) == 0:
+    asg_names = os.environ.get('ASG_NAMES', '').replace(',', ' ').split()
+    if len(asg_names) == 0:
+        print "Inventory mode needs ASG names (ASG_NAMES environment variable)"
+        quit(2)
+
+# ASG names come from the command line, or one per line on stdin if none given (or '-')
+if len(asg_names) == 0 or asg_names == ['-']:
+    if sys.stdin.isatty():
+        print "Missing required argument -- asg name"
+        quit(2)
+    asg_names = sys.stdin.read().split()
+if len(asg_names) == 0:
+    print "Missing required argument -- asg name"
     quit(2)
+# Drop duplicate names but keep the order they were given in
+asg_names = [asg for i, asg in enumerate(asg_names) if asg not in asg_names[:i]]
+
+
+def lookup_region(region_client):
+    region, asg_client = region_client
+    return region, get_asg_instance_ids(asg_client, asg_names, args.lifecycle_state, args.health_status)
+
+
+cache_file = get_cache_file(regions, asg_names, args.lifecycle_state, args.health_status)
+lookups = read_cache(cache_file, cache_ttl)
+if lookups is None:
+    # Instance-ids come straight from the ASG, so no ec2 client is needed. Clients are created
+    # up front (client creation is not thread safe) and the regions are then looked up in parallel
+    region_clients = [(r, boto3.client('autoscaling', region_name=r)) for r in regions]
+    pool = ThreadPool(len(regions))
+    lookups = dict(pool.map(lookup_region, region_clients))
+    pool.close()
+    if cache_ttl > 0:
+        write_cache(cache_file, lookups)
+
+if inventory_mode:
+    inventory = get_inventory(asg_names, lookups)
+    if args.host is not None:
+        print json.dumps(inventory['_meta']['hostvars'].get(args.host, {}), indent=2)
+    else:
+        print json.dumps(inventory, indent=2)
+    quit(0)
+
+exit_code = 0
+for asg in asg_names:
+    found_regions = [r for r in regions if asg in lookups[r]]
+    if len(found_regions) == 0:
+        print "Autoscale group name '%s' not found!" % asg
+        exit_code = 2
+        continue
+    for region in found_regions:
+        instance_ids = lookups[region][asg] # List of instance-ids
+        if len(instance_ids) == 0:
+            print "No instances found in ASG '%s' (%s)!" % (asg, region)
+            exit_code = 2
+        elif len(regions) > 1:
+            for x in instance_ids:
+                print "%s\t%s\t%s" % (region, asg, x)
+        elif len(asg_names) == 1:
+            for x in instance_ids:
+                print x,
+        else:
+            for x in instance_ids:
+                print "%s\t%s" % (asg, x)
+quit(exit_code)
@@ -5,113 +5,444 @@
 #
 #   Input arg1: aws region
 #   Input arg2: tag suffix for environment to query, ex. dev-ue2
+#
+#   Empty strings, nulls and whitespace-only values are reported by path at any depth
+#   of a JSON secret, optionally 'pip install ijson' to parse large secrets incrementally
+#
+#   --profiles/--regions scan several accounts and regions at once, and --report
+#   merges the findings of every account/region into one JSON file
 
 import boto3
-import sys
 from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import deque
+from datetime import datetime, timezone
+import threading
+import argparse
 import json
+import os
+import re
+import time
+# ijson is optional, if installed secret strings are parsed incrementally instead of loaded whole
+try:
+    import ijson
+    ijson_installed = True
+    json_errors = (ValueError, ijson.JSONError)
+except ImportError:
+    ijson_installed = False
+    json_errors = (ValueError,)
 
-if (args_count := len(sys.argv)) > 3:
-    print(f"Two arguments expected, got {args_count - 1}")
-    raise SystemExit(2)
-elif args_count < 3:
-    print("You must specify 2 arguments: aws region, and tag suffix")
-    raise SystemExit(2)
-
-print("Starting check-empty-aws-secrets.py script")
-print(f'Region: {sys.argv[1]}')
-print(f'Tag suffix: {sys.argv[2]}')
-
-# Uncomment the following line to use a local aws profile
-#boto3.setup_default_session(profile_name='staging')
-
-my_config = Config(
-    region_name = sys.argv[1],
-    signature_version = 'v4',
-    retries = {
-        'max_attempts': 3,
-        'mode': 'standard'
-    }
-)
+script_name = os.path.basename(__file__)
 
-try:
-    client = boto3.client('secretsmanager', config=my_config)
-except Exception as error:
-    print(f'Error: {error}')
-    exit(2)
+# Bump when the checks or cached result format change so older cached results are not reused
+cache_version = 3
 
-# Fetch all secrets in the first 100 results
-try:
-    response = client.list_secrets(
-        MaxResults=100,
-        SortOrder='asc'
+# batch_get_secret_value accepts at most 20 secret ids per call
+batch_size = 20
+
+# Max number of account/region targets scanned at the same time
+max_target_workers = 8
+
+# Get cli arguments
+parser = argparse.ArgumentParser(description="Loop over AWS Secrets Manager secrets and show any that have empty values")
+parser.add_argument("region", help="AWS Region", type=str)
+parser.add_argument("tag_suffix", help="AWS Tag Suffix, ex. dev-ue2", type=str)
+parser.add_argument("--regions", help="Comma separated extra AWS Regions to scan at the same time", type=str)
+parser.add_argument("--profiles", help="Comma separated AWS Profile names (accounts) to scan at the same time", type=str)
+parser.add_argument("--report", help="Write the merged findings of every account/region to this JSON file", type=str)
+parser.add_argument("--workers", help="Number of secret values fetched at the same time per account/region (default: 8)", type=int, default=8)
+parser.add_argument("--rate", help="Max GetSecretValue/BatchGetSecretValue calls per second per account/region (default: 50)", type=float, default=50)
+parser.add_argument("--cache-file", help="Scan cache file, secrets whose version is unchanged are not fetched again (default: ~/.cache/check-empty-aws-secrets/[<profile>_]<region>_<tag_suffix>.json)", type=str)
+parser.add_argument("--full", help="Ignore the scan cache and fetch every secret value", action="store_true")
+parser.add_argument("--bulk", help="Fetch secret values 20 at a time with BatchGetSecretValue", action="store_true")
+args = parser.parse_args()
+
+# Every profile is scanned in every region
+regions = list(dict.fromkeys([args.region] + [r.strip() for r in (args.regions or '').split(',') if r.strip() != '']))
+profiles = list(dict.fromkeys([p.strip() for p in (args.profiles or '').split(',') if p.strip() != ''])) or [None]
+targets = [(profile, region) for profile in profiles for region in regions]
+fan_out = len(targets) > 1
+if fan_out and args.cache_file:
+    parser.error('--cache-file can only be used when scanning a single account/region')
+
+print(f'Starting {script_name} script')
+print(f'Region: {", ".join(regions)}')
+print(f'Tag suffix: {args.tag_suffix}')
+if profiles != [None]:
+    print(f'Using AWS Profiles: {", ".join(profiles)}')
+
+print_lock = threading.Lock()
+
+
+class TokenBucket:
+    """ Allow at most rate calls per second on average, with bursts of up to rate calls """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def iter_secrets(client, name_filter):
+    """ Yield every secret page by page, narrowed server-side by the name filter. The name filter
+        matches words within the secret name, so callers still check the suffix themselves """
+    paginator = client.get_paginator('list_secrets')
+    for page in paginator.paginate(
+        Filters=[
+            {
+                'Key': 'name',
+                'Values': [name_filter]
+            },
+        ],
+        SortOrder='asc',
+        PaginationConfig={'PageSize': 100}
+    ):
+        yield from page['SecretList']
+
+
+def format_path(path):
+    """ ['db', 'hosts', 0, 'name'] -> db.hosts[0].name """
+    formatted = ''
+    for part in path:
+        if isinstance(part, int):
+            formatted += f'[{part}]'
+        elif re.fullmatch(r'[A-Za-z0-9_\-]+', part):
+            formatted += f'.{part}' if formatted else part
+        else:
+            formatted += f'[{json.dumps(part)}]'
+    return formatted or '(secret string)'
+
+
+def check_value(path, value, findings):
+    if value is None:
+        findings.append((format_path(path), 'null'))
+    elif isinstance(value, str) and value == '':
+        findings.append((format_path(path), 'empty'))
+    elif isinstance(value, str) and value.strip() == '':
+        findings.append((format_path(path), 'whitespace-only'))
+
+
+def walk_json(value, path, findings):
+    """ Check every value in a loaded JSON document, recursing into objects and arrays """
+    if isinstance(value, dict):
+        for key, item in value.items():
+            walk_json(item, path + [key], findings)
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            walk_json(item, path + [index], findings)
+    else:
+        check_value(path, value, findings)
+
+
+def walk_json_events(events, findings):
+    """ Same as walk_json but over ijson parse events, so the document is never held in memory whole """
+    path = []
+    for prefix, event, value in events:
+        if event == 'map_key':
+            path[-1] = value
+            continue
+        if event in ('end_map', 'end_array'):
+            path.pop()
+            continue
+        if len(path) > 0 and isinstance(path[-1], int):
+            # Each new item in an array moves the index on
+            path[-1] += 1
+        if event == 'start_map':
+            path.append(None)
+        elif event == 'start_array':
+            path.append(-1)
+        else:
+            check_value(path, value, findings)
+
+
+def check_secret_string(secret_string):
+    """ Return the result for one secret value, JSON secrets are checked at every depth
+        and anything else is checked as a single plain string """
+    if secret_string is None:
+        return {'findings': [], 'note': 'Binary secret, not checked'}
+    findings = []
+    try:
+        if ijson_installed:
+            walk_json_events(ijson.parse(secret_string.encode('utf-8')), findings)
+        else:
+            walk_json(json.loads(secret_string), [], findings)
+    except json_errors:
+        findings = []
+        check_value([], secret_string, findings)
+    return {'findings': [[path, kind] for path, kind in findings]}
+
+
+def result_lines(secret, result):
+    """ Lines to print for one secret result """
+    lines = []
+    if 'error' in result:
+        lines.append(f'Error: {result["error"]}')
+    if 'note' in result:
+        lines.append(f'*** {result["note"]}')
+    for path, kind in result['findings']:
+        lines.append(f'\tSecret "{secret}" has {kind} value for {path}')
+    return lines
+
+
+def copy_future(source, target):
+    """ Complete target with the outcome of the finished source future """
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+def get_client(profile, region):
+    # Adaptive retries back off and slow the client down when Secrets Manager throttles us
+    my_config = Config(
+        region_name = region,
+        signature_version = 'v4',
+        retries = {
+            'max_attempts': 10,
+            'mode': 'adaptive'
+        },
+        max_pool_connections = args.workers
     )
-except Exception as error:
-    print(f'Error: {error}')
-    exit(2)
+    session = boto3.Session(profile_name=profile) if profile else boto3.Session()
+    return session.client('secretsmanager', config=my_config)
 
-# Add all secret names in the first 100 secrets to a list
-secret_names_list = []
-for secret in response['SecretList']:
-    secret_names_list.append(secret['Name'])
 
-# Fetch all secret names in the next 100 secrets if more than 100
-try:
-    if len(response['NextToken']) > 0:
+def get_cache_file(profile, region):
+    # The cache holds secret ARN, version and the last check result, never secret values. It only
+    #   holds the secrets of one tag suffix, so each suffix gets its own file
+    if args.cache_file:
+        return args.cache_file
+    tag_suffix = re.sub(r'[^A-Za-z0-9_.\-]', '_', args.tag_suffix)
+    cache_name = f'{profile}_{region}_{tag_suffix}' if profile else f'{region}_{tag_suffix}'
+    return os.path.join(os.path.expanduser('~'), '.cache', 'check-empty-aws-secrets', f'{cache_name}.json')
+
+
+def load_cache(cache_file):
+    if args.full:
+        return {}
+    try:
+        with open(cache_file) as file:
+            cache = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    # Results cached by an older version of the checks are thrown away
+    if cache.get('CacheVersion') != cache_version:
+        return {}
+    return cache['Secrets']
+
+
+def save_cache(cache_file, cache):
+    os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+    # Write then rename so an interrupted run never leaves a partial cache behind
+    with open(f'{cache_file}.tmp', 'w') as file:
+        json.dump({'CacheVersion': cache_version, 'Secrets': cache}, file, indent=2, sort_keys=True)
+    os.replace(f'{cache_file}.tmp', cache_file)
+
+
+def get_secret_version(secret_entry):
+    """ Return (current VersionId, LastChangedDate) from the list_secrets metadata """
+    version_id = None
+    for version, stages in secret_entry.get('SecretVersionsToStages', {}).items():
+        if 'AWSCURRENT' in stages:
+            version_id = version
+    return version_id, str(secret_entry.get('LastChangedDate'))
+
+
+def scan_target(profile, region, client):
+    """ Scan one account/region, printing results as they come, and return its summary and findings.
+        Secret values are fetched on a bounded pool under a rate limit while listing continues,
+        results are printed in listing order as soon as the oldest outstanding fetch is done """
+    label = f'[{profile or "default"}/{region}] ' if fan_out else ''
+    cache_file = get_cache_file(profile, region)
+    cache = load_cache(cache_file)
+    new_cache = {}
+    secret_versions = {}
+    # Secrets Manager quotas are per account and region, so each target gets its own limiter
+    rate_limiter = TokenBucket(args.rate)
+    pending = deque()
+    # Secrets collected for the next BatchGetSecretValue call, and the placeholder future queued in
+    #   pending for them which gets the call's result once it is submitted
+    batch = []
+    batch_future = Future()
+    summary = {'profile': profile, 'region': region, 'secrets_matched': 0, 'unchanged': 0, 'findings': [], 'errors': []}
+
+    def output(line):
+        with print_lock:
+            print(f'{label}{line}')
+
+    def check_secret(secret):
+        """ Fetch one secret value and return {secret: result}, or raise on API errors """
+        rate_limiter.acquire()
+        secret_value = client.get_secret_value(
+            SecretId=secret
+        )
+        return {secret: check_secret_string(secret_value.get('SecretString'))}
+
+    def check_secrets_batch(secrets):
+        """ Fetch up to 20 secret values in one call and return {secret: result}, errors for
+            individual secrets are reported in their result rather than raised """
+        results = {}
+        next_token = None
+        while True:
+            rate_limiter.acquire()
+            if next_token is None:
+                response = client.batch_get_secret_value(SecretIdList=secrets)
+            else:
+                response = client.batch_get_secret_value(SecretIdList=secrets, NextToken=next_token)
+            for secret_value in response.get('SecretValues', []):
+                results[secret_value['Name']] = check_secret_string(secret_value.get('SecretString'))
+            for error in response.get('Errors', []):
+                results[error['SecretId']] = {'findings': [], 'error': f'{error.get("ErrorCode")} {error.get("ErrorMessage")}'}
+            next_token = response.get('NextToken')
+            if not next_token:
+                break
+        for secret in secrets:
+            results.setdefault(secret, {'findings': [], 'error': 'secret missing from BatchGetSecretValue response'})
+        return results
+
+    def submit_batch():
+        """ Send the collected secrets off as one BatchGetSecretValue call, completing their placeholder """
+        nonlocal batch_future
+        if len(batch) == 0:
+            return
+        placeholder = batch_future
+        future = executor.submit(check_secrets_batch, list(batch))
+        future.add_done_callback(lambda done: copy_future(done, placeholder))
+        batch.clear()
+        batch_future = Future()
+
+    def print_result(secret, future):
+        """ Print and record the result of one secret, future is None for skipped secrets """
+        output(f'Found secret: {secret}')
+        if future is None:
+            output(f'Skipping secret: {secret}')
+            return
+        result = future.result()[secret]
+        for line in result_lines(secret, result):
+            output(line)
+        arn, version_id, last_changed = secret_versions[secret]
+        for path, kind in result['findings']:
+            summary['findings'].append({'secret': secret, 'arn': arn, 'path': path, 'kind': kind})
+        if 'error' in result:
+            # Errors are not cached so the secret is fetched again next run
+            summary['errors'].append({'secret': secret, 'arn': arn, 'error': result['error']})
+        else:
+            new_cache[arn] = {'Name': secret, 'VersionId': version_id, 'LastChangedDate': last_changed, 'Result': result}
+
+    # Cached secrets queue up behind a batch while it is collected, so allow room for full batches in bulk mode
+    max_pending = args.workers * 4 * (batch_size if args.bulk else 1)
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
         try:
-            response = client.list_secrets(
-                MaxResults=100,
-                NextToken=response['NextToken'],
-                SortOrder='asc'
-            )
-        except Exception as error:
-            print(f'Error: {error}')
-            exit(2)
-        for secret in response['SecretList']:
-            secret_names_list.append(secret['Name'])
-except KeyError:
-    #print('Found 100 or less secrets')
-    pass
-
-# Print out the total number of secrets we found
-num_of_secrets = len(secret_names_list)
-print(f'Retrieved {num_of_secrets} total secrets from {sys.argv[1]}\n')
+            for secret_entry in iter_secrets(client, args.tag_suffix):
+                secret = secret_entry['Name']
+                if secret.endswith(args.tag_suffix):
+                    summary['secrets_matched'] += 1
+                    skip_secret_name = secret.strip()
+                    skip = skip_secret_name in skip_secret_list_full_name
+                    version_id, last_changed = get_secret_version(secret_entry)
+                    secret_versions[secret] = (secret_entry['ARN'], version_id, last_changed)
+                    cached = cache.get(secret_entry['ARN'])
+                    if not skip and version_id is not None and cached is not None and \
+                            (cached['VersionId'], cached['LastChangedDate']) == (version_id, last_changed):
+                        # Unchanged since the last scan, reuse the cached result instead of fetching the value
+                        summary['unchanged'] += 1
+                        future = Future()
+                        future.set_result({secret: cached['Result']})
+                        pending.append((secret, future))
+                    elif skip:
+                        pending.append((skip_secret_name, None))
+                    elif args.bulk:
+                        # Queued in listing order now, cached secrets in between do not cut the batch short
+                        batch.append(secret)
+                        pending.append((secret, batch_future))
+                        if len(batch) == batch_size:
+                            submit_batch()
+                    else:
+                        pending.append((secret, executor.submit(check_secret, secret)))
+                # Print what is ready, and wait on the oldest fetch once too many are outstanding
+                while len(pending) > 0 and (pending[0][1] is None or pending[0][1].done() or len(pending) > max_pending):
+                    if pending[0][1] is batch_future:
+                        # The oldest secret is waiting on the batch still being collected
+                        submit_batch()
+                    print_result(*pending.popleft())
+            submit_batch()
+            while len(pending) > 0:
+                print_result(*pending.popleft())
+        except BaseException:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+    save_cache(cache_file, new_cache)
+
+    # Print out the total number of secrets we found
+    output(f'Retrieved {summary["secrets_matched"]} secrets matching "{args.tag_suffix}" from {region}')
+    output(f'{summary["unchanged"]} secrets unchanged since the last scan (not fetched), cache: {cache_file}')
+    return summary
+
 
 # List of secrets to skip because we cannot parse their secret string for whatever reason
 skip_secret_list = ["skip-secret-"]
 
 skip_secret_list_full_name = []
 for skip_secret in skip_secret_list:
-    skip_secret_list_full_name.append(f'{skip_secret}{sys.argv[2]}')
+    skip_secret_list_full_name.append(f'{skip_secret}{args.tag_suffix}')
 
 print('Skipping these secret names (unable to parse secret string):')
 print(skip_secret_list_full_name)
 print('\n')
 
-# Loop over all secret names check if any keys in secret have empty values and print out
-for secret in secret_names_list:
-    if secret.endswith(sys.argv[2]):
-        skip_secret_name = secret.strip()
-        print(f'Found secret: {skip_secret_name}')
-        if skip_secret_name in skip_secret_list_full_name:
-            print(f'Skipping secret: {skip_secret_name}')
-            continue
-        try:
-            secret_value = client.get_secret_value(
-                SecretId=secret
-            )
-        except Exception as error:
-            print(f'Error: {error}')
-            exit(2)
-        secret_string = secret_value['SecretString']
+# One client (and connection pool) per account/region, created up front since client creation is not thread safe
+try:
+    clients = {target: get_client(*target) for target in targets}
+except Exception as error:
+    print(f'Error: {error}')
+    exit(2)
+
+summaries = []
+if not fan_out:
+    try:
+        summaries.append(scan_target(*targets[0], clients[targets[0]]))
+    except Exception as error:
+        print(f'Error: {error}')
+        exit(2)
+else:
+    with ThreadPoolExecutor(max_workers=min(max_target_workers, len(targets))) as target_executor:
+        futures = {target: target_executor.submit(scan_target, *target, clients[target]) for target in targets}
+    for (profile, region), future in futures.items():
         try:
-            secret_string = json.loads(secret_string)
+            summaries.append(future.result())
         except Exception as error:
-            print(f'*** json.loads Error: {error}')
-            continue
-        for key, value in secret_string.items():
-            if value == '':
-                print(f'\tSecret "{secret}" has empty value for {key}')
+            print(f'[{profile or "default"}/{region}] Error: {error}')
+            summaries.append({'profile': profile, 'region': region, 'error': str(error), 'findings': [], 'errors': []})
+
+if args.report:
+    report = {
+        'generated': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'tag_suffix': args.tag_suffix,
+        'targets': [{key: summary.get(key) for key in ('profile', 'region', 'secrets_matched', 'unchanged', 'error')} for summary in summaries],
+        'findings': [{'profile': summary['profile'], 'region': summary['region'], **finding} for summary in summaries for finding in summary['findings']],
+        'errors': [{'profile': summary['profile'], 'region': summary['region'], **error} for summary in summaries for error in summary['errors']],
+    }
+    with open(args.report, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f'\nWrote {len(report["findings"])} findings from {len(summaries)} accounts/regions to {args.report}')
 
 print("Done")
+# Fail on targets that could not be scanned and on secrets whose value could not be fetched
+if any('error' in summary or len(summary['errors']) > 0 for summary in summaries):
+    exit(2)
 exit(0)
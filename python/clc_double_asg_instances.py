@@ -60,6 +60,9 @@ import datetime
 import re
 import subprocess
 import shlex
+import math
+import json
+import threading
 
 # Check Python version and exit if not at least 2.7
 req_version = (2, 7)
@@ -75,6 +78,19 @@ debug = True
 # If True logs are also printed to screen
 print_log = False
 
+# Launch-to-InService time (seconds) assumed when the ASG has no launch history to plan from
+default_launch_seconds = 300
+
+# How often (seconds) to poll the ASG/warm pool while waiting, and how long to wait before giving up
+poll_seconds = 15
+wait_timeout_seconds = 1800
+
+# Directory the pre-scale ASG settings are saved to, read back by --restore
+snapshot_dir = os.path.join(os.path.expanduser("~"), ".clc_asg_snapshots")
+
+# set_instance_protection accepts at most this many instance ids per call
+protection_batch_size = 50
+
 # Get name, path, version of this script
 script_name = __file__
 script_path = os.path.dirname(os.path.abspath(__file__))
@@ -98,6 +114,9 @@ def printhelp():
     print "Usage3: %s -a <autoscale group name> -r <region>" % script_name
     print "Usage4: %s -a <autoscale group name> -p <aws profile name>" % script_name
     print "Usage5: %s -a <autoscale group name> -r <region> -p <aws profile name>" % script_name
+    print "Usage6: %s -a <autoscale group name> -n 4 --plan" % script_name
+    print "Usage7: %s -a <autoscale group name> --warmpool --warmpoolstate Stopped" % script_name
+    print "Usage8: %s -a <asg name>,<asg name> --restore --drain" % script_name
     print " "
     print "Required args:"
     print "-a | --asg           Autoscale group name"
@@ -105,6 +124,13 @@ def printhelp():
     print "Optional args:"
     print "-w | --wait          Amount of time in seconds to wait between increasing the ASG Desired/Min count (default: 60 seconds)"
     print "-s | --suspend       Suspend specified process (default: 'ScheduledActions')"
+    print "-n | --steps         Number of increments to double the ASG Desired/Min count in (default: 4)"
+    print "--plan               Dry run, predict step timings from the ASG scaling history without changing the ASG"
+    print "--warmpool           Create/resize the ASG warm pool to the doubling size and wait for it to be Warmed before scaling"
+    print "--warmpoolstate      State of warmed instances, one of [Stopped, Running, Hibernated] (default: Stopped)"
+    print "--restore            Scale back down, in increments, to the settings saved before the ASG was doubled"
+    print "                     (comma separate multiple ASG names to restore them concurrently)"
+    print "--drain              With --restore, protect the pre-scale instances from scale-in so the added instances are removed"
     print "-p | --profile       AWS profile name (generated by 'aws configure'), IAM role used if profile not specified"
     print "-r | --region        Specify AWS region (default: us-east-1)"
     print "-d | --debuglevel    Level of logging (debug, info, warning, error, critical)"
@@ -124,6 +150,12 @@ parser = argparse.ArgumentParser(description="This script is helpful for connect
 parser.add_argument("-a", "--asg", type=str, help="Specify an autoscale group name")
 parser.add_argument("-w", "--wait", type=str, help="Specify a wait time in between scaling events in seconds")
 parser.add_argument("-s", "--suspend", type=str, help="Specify an action to suspend in the ASG")
+parser.add_argument("-n", "--steps", type=str, help="Specify the number of increments to double the ASG in")
+parser.add_argument("--plan", action="store_true", help="Dry run, predict step timings from the ASG scaling history")
+parser.add_argument("--warmpool", action="store_true", help="Provision an ASG warm pool sized to the doubling before scaling")
+parser.add_argument("--warmpoolstate", type=str, choices=["Stopped", "Running", "Hibernated"], help="State of warmed instances (default: Stopped)")
+parser.add_argument("--restore", action="store_true", help="Scale back down to the settings saved before the ASG was doubled")
+parser.add_argument("--drain", action="store_true", help="With --restore, protect the pre-scale instances from scale-in")
 parser.add_argument("-p", "--profile", type=str, help="AWS profile name (generated by 'aws configure'), IAM role used if profile not specified")
 parser.add_argument("-r", "--region", type=str, help="Specify AWS region (default: us-east-1)")
 parser.add_argument("-d", "--debugLevel", type=str, choices=["debug", "info", "warning", "error", "critical"], help="Set debug level")
@@ -168,6 +200,42 @@ if hasattr(args, "wait") and args.wait is not None:
 else:
     wait_seconds = 60
 
+# Optional arg, get number of increments to double min/desired capacity in
+steps_set = False
+if hasattr(args, "steps") and args.steps is not None:
+    ramp_steps = args.steps
+    ramp_steps = ramp_steps.strip()
+    ramp_steps = int(ramp_steps)
+    if ramp_steps < 1:
+        print " "
+        print "Argument 'steps' must be at least 1!"
+        printhelp()
+    steps_set = True
+else:
+    ramp_steps = 4
+
+# Optional arg, only plan the capacity ramp (no changes are made to the ASG)
+plan_only = False
+if hasattr(args, "plan") and args.plan is True:
+    plan_only = True
+
+# Optional arg, provision a warm pool sized to the doubling before running the capacity ramp
+warm_pool = False
+if hasattr(args, "warmpool") and args.warmpool is True:
+    warm_pool = True
+if hasattr(args, "warmpoolstate") and args.warmpoolstate is not None:
+    warm_pool_state = args.warmpoolstate
+else:
+    warm_pool_state = 'Stopped'
+
+# Optional arg, restore the ASG(s) to the snapshot taken before doubling, optionally draining the added instances
+restore_mode = False
+if hasattr(args, "restore") and args.restore is True:
+    restore_mode = True
+drain_set = False
+if hasattr(args, "drain") and args.drain is True:
+    drain_set = True
+
 # Optional arg, get process to suspend so scheduled scaling events are suspended, default 'ScheduledActions'
 suspend_process_set = False
 if hasattr(args, "suspend") and args.suspend is not None:
@@ -330,6 +398,10 @@ if debugLog is not "":
     logger("debugLog = '%s'" % debugLog, "debug")
 logger("AWS autoscale group name specified = '%s'" % asg_name, "debug")
 logger("AWS profile specified = '%s'" % aws_profile, "debug")
+logger("Ramp steps = '%s'" % ramp_steps, "debug")
+logger("Plan only = '%s'" % plan_only, "debug")
+logger("Warm pool = '%s' (state '%s')" % (warm_pool, warm_pool_state), "debug")
+logger("Restore = '%s' (drain '%s')" % (restore_mode, drain_set), "debug")
 if profile_region_set is False and region_set is False:
     logger("AWS region (from HTTP GET metadata url) = '%s'" % aws_region, "debug")
     logger("AWS availabilityZone (from HTTP GET metadata url) = '%s'" % aws_az, "debug")
@@ -389,7 +461,7 @@ def get_asg_settings(autoscaling_group_name):
         print "Greater than 1 autoscale group returned"
         quit(2)
     if len(auto_scale_group['AutoScalingGroups']) == 1:
-        print("Found ASG: %s" % asg_name)
+        print("Found ASG: %s" % ", ".join(autoscaling_group_name))
         for asg in auto_scale_group['AutoScalingGroups']:
             print("Current 'Desired Capacity' setting: %s" % asg['DesiredCapacity'])
             print("Current 'Min' setting: %s" % asg['MinSize'])
@@ -417,14 +489,423 @@ def update_asg_settings(autoscaling_group_name, min_setting, max_setting, desire
         quit(2)
     print response
 
+
+def get_launch_durations(autoscaling_group_name):
+    """ Page through the ASG scaling activities and return launch-to-InService durations in seconds """
+    launch_durations = []
+    try:
+        paginator = asg_client.get_paginator('describe_scaling_activities')
+        for page in paginator.paginate(AutoScalingGroupName=autoscaling_group_name):
+            for activity in page['Activities']:
+                if activity['StatusCode'] != 'Successful' or 'EndTime' not in activity:
+                    continue
+                if not activity['Description'].startswith('Launching a new EC2 instance'):
+                    continue
+                launch_durations.append((activity['EndTime'] - activity['StartTime']).total_seconds())
+    except ClientError as err:
+        logger("Boto3 autoscaling describe_scaling_activities failed  Error: %s   Exiting script" % err, "critical")
+        printstring = "Boto3 autoscaling describe_scaling_activities failed  Error: %s   Exiting script" % err
+        print("{0}".format(colored(printstring, 'red')))
+        quit(2)
+    logger("Found %s historical launch activities for ASG '%s'" % (len(launch_durations), autoscaling_group_name), "debug")
+    return launch_durations
+
+
+def percentile(values, pct):
+    """ Return the pct percentile (nearest rank) of a non-empty list of numbers """
+    ordered = sorted(values)
+    index = int(round((pct / 100.0) * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def get_ramp_steps(start_min, start_desired, target_min, target_desired, step_count):
+    """ Return the list of (min, desired) settings to apply, in order, to go from start to target """
+    def get_step_setting(start, target, step):
+        # Round toward the target, scaling up or down, so the first step never repeats the start settings
+        change = (target - start) * step / float(step_count)
+        return start + int(math.ceil(change) if change > 0 else math.floor(change))
+
+    ramp = []
+    for step in range(1, step_count + 1):
+        step_min = get_step_setting(start_min, target_min, step)
+        step_desired = get_step_setting(start_desired, target_desired, step)
+        if len(ramp) > 0 and ramp[-1] == (step_min, step_desired):
+            continue
+        ramp.append((step_min, step_desired))
+    return ramp
+
+
+def plan_capacity_ramp(autoscaling_group_name, ramp, start_desired, target_max, current_max):
+    """ Simulate the stepped ramp offline using historical launch durations, no changes are made to the ASG """
+    launch_durations = get_launch_durations(autoscaling_group_name)
+    if len(launch_durations) > 0:
+        launch_seconds = percentile(launch_durations, 90)
+        print("Historical launch-to-InService from %s launches: median %ds, p90 %ds, max %ds" % (
+            len(launch_durations), percentile(launch_durations, 50), launch_seconds, max(launch_durations)))
+    else:
+        launch_seconds = default_launch_seconds
+        printstring = "No launch history found for ASG '%s', assuming %ds per step" % (autoscaling_group_name, launch_seconds)
+        print("{0}".format(colored(printstring, 'yellow')))
+    # Instances launched in one step come up in parallel, so each step is planned at the p90 launch time
+    elapsed = 0
+    previous_desired = start_desired
+    for step, (step_min, step_desired) in enumerate(ramp, 1):
+        added = step_desired - previous_desired
+        in_service_at = elapsed + (launch_seconds if added > 0 else 0)
+        print("Step %s: T+%ds set Min=%s Desired=%s (+%s instances), predicted InService at T+%ds" % (
+            step, elapsed, step_min, step_desired, added, in_service_at))
+        previous_desired = step_desired
+        elapsed = in_service_at
+        if step < len(ramp):
+            elapsed += wait_seconds
+    print("Predicted total ramp time: %ds (%.1f minutes)" % (elapsed, elapsed / 60.0))
+    final_min, final_desired = ramp[-1]
+    print("Predicted final settings: Min=%s Max=%s Desired=%s" % (final_min, target_max, final_desired))
+    if target_max > current_max:
+        printstring = "Doubled Desired (%s) does not fit under current MaxSize (%s), Max would be raised to %s" % (final_desired, current_max, target_max)
+        print("{0}".format(colored(printstring, 'yellow')))
+    else:
+        print("Doubled Desired (%s) fits under current MaxSize (%s)" % (final_desired, current_max))
+
+def suspend_asg_process(autoscaling_group_name, process_name):
+    try:
+        asg_client.suspend_processes(AutoScalingGroupName=autoscaling_group_name, ScalingProcesses=[process_name])
+    except ClientError as err:
+        logger("Boto3 autoscaling suspend_processes failed  Error: %s   Exiting script" % err, "critical")
+        printstring = "Boto3 autoscaling suspend_processes failed  Error: %s   Exiting script" % err
+        print("{0}".format(colored(printstring, 'red')))
+        quit(2)
+    print("Suspended process '%s' on ASG: %s" % (process_name, autoscaling_group_name))
+
+
+def get_asg_instances(autoscaling_group_name):
+    """ Return the list of instances (InstanceId, LifecycleState, ProtectedFromScaleIn, ...) in the ASG """
+    try:
+        auto_scale_group = asg_client.describe_auto_scaling_groups(AutoScalingGroupNames=[autoscaling_group_name])
+    except ClientError as err:
+        logger("Boto3 autoscaling describe_auto_scaling_groups failed  Error: %s   Exiting script" % err, "critical")
+        printstring = "Boto3 autoscaling describe_auto_scaling_groups failed  Error: %s   Exiting script" % err
+        print("{0}".format(colored(printstring, 'red')))
+        quit(2)
+    instances = []
+    for asg in auto_scale_group['AutoScalingGroups']:
+        instances.extend(asg['Instances'])
+    return instances
+
+
+def get_in_service_count(autoscaling_group_name):
+    """ Return the number of ASG instances in the InService lifecycle state """
+    in_service = 0
+    for instance in get_asg_instances(autoscaling_group_name):
+        if instance['LifecycleState'] == 'InService':
+            in_service += 1
+    return in_service
+
+
+def wait_for_in_service(autoscaling_group_name, desired_setting):
+    """ Poll the ASG until at least desired_setting instances are InService """
+    wait_start = time.time()
+    while True:
+        in_service = get_in_service_count(autoscaling_group_name)
+        if in_service >= desired_setting:
+            print("%s/%s instances InService after %ds" % (in_service, desired_setting, time.time() - wait_start))
+            return
+        if time.time() - wait_start > wait_timeout_seconds:
+            logger("Timed out after %ds waiting for %s InService instances in ASG '%s'   Exiting script" % (wait_timeout_seconds, desired_setting, autoscaling_group_name), "critical")
+            printstring = "Timed out after %ds waiting for %s InService instances (%s InService)   Exiting script" % (wait_timeout_seconds, desired_setting, in_service)
+            print("{0}".format(colored(printstring, 'red')))
+            quit(2)
+        print("Waiting for instances to be InService: %s/%s" % (in_service, desired_setting))
+        time.sleep(poll_seconds)
+
+
+def get_warm_pool_configuration(autoscaling_group_name):
+    """ Return the ASG WarmPoolConfiguration, or None if the ASG has no warm pool """
+    try:
+        response = asg_client.describe_warm_pool(AutoScalingGroupName=autoscaling_group_name)
+    except ClientError as err:
+        logger("Boto3 autoscaling describe_warm_pool failed  Error: %s   Exiting script" % err, "critical")
+        printstring = "Boto3 autoscaling describe_warm_pool failed  Error: %s   Exiting script" % err
+        print("{0}".format(colored(printstring, 'red')))
+        quit(2)
+    return response.get('WarmPoolConfiguration')
+
+
+def get_warmed_count(autoscaling_group_name, pool_state):
+    """ Return the number of warm pool instances that finished warming, Warmed:<pool_state>
+        (not Warmed:Pending* or Warmed:Terminating*) """
+    warmed = 0
+    next_token = ""
+    while next_token is not None:
+        try:
+            if next_token == "":
+                response = asg_client.describe_warm_pool(AutoScalingGroupName=autoscaling_group_name)
+            else:
+                response = asg_client.describe_warm_pool(AutoScalingGroupName=autoscaling_group_name, NextToken=next_token)
+        except ClientError as err:
+            logger("Boto3 autoscaling describe_warm_pool failed  Error: %s   Exiting script" % err, "critical")
+            printstring = "Boto3 autoscaling describe_warm_pool failed  Error: %s   Exiting script" % err
+            print("{0}".format(colored(printstring, 'red')))
+            quit(2)
+        for instance in response.get('Instances', []):
+            if instance['LifecycleState'] == 'Warmed:%s' % pool_state:
+                warmed += 1
+        next_token = response.get('NextToken')
+    return warmed
+
+
+def provision_warm_pool(autoscaling_group_name, warm_size, prepared_capacity, pool_state):
+    """ Create or resize the ASG warm pool and wait until warm_size instances are Warmed """
+    try:
+        asg_client.put_warm_pool(AutoScalingGroupName=autoscaling_group_name, MinSize=warm_size,
+                                 MaxGroupPreparedCapacity=prepared_capacity, PoolState=pool_state)
+    except ClientError as err:
+        logger("Boto3 autoscaling put_warm_pool failed  Error: %s   Exiting script" % err, "critical")
+        printstring = "Boto3 autoscaling put_warm_pool failed  Error: %s   Exiting script" % err
+        print("{0}".format(colored(printstring, 'red')))
+        quit(2)
+    print("Warm pool for ASG %s set to %s instances (%s)" % (autoscaling_group_name, warm_size, pool_state))
+    wait_start = time.time()
+    while True:
+        warmed = get_warmed_count(autoscaling_group_name, pool_state)
+        if warmed >= warm_size:
+            print("%s/%s warm pool instances Warmed after %ds" % (warmed, warm_size, time.time() - wait_start))
+            return
+        if time.time() - wait_start > wait_timeout_seconds:
+            logger("Timed out after %ds waiting for %s Warmed instances in ASG '%s'   Exiting script" % (wait_timeout_seconds, warm_size, autoscaling_group_name), "critical")
+            printstring = "Timed out after %ds waiting for %s Warmed instances (%s Warmed)   Exiting script" % (wait_timeout_seconds, warm_size, warmed)
+            print("{0}".format(colored(printstring, 'red')))
+            quit(2)
+        print("Waiting for warm pool instances to be Warmed: %s/%s" % (warmed, warm_size))
+        time.sleep(poll_seconds)
+
+
+def shrink_warm_pool(autoscaling_group_name, warm_pool_config, prepared_capacity, pool_state):
+    """ Once the ramp has used the warm instances, stop the pool refilling to warm_size: put back the
+        pre-existing warm pool settings, or set MinSize 0 on a pool this script created """
+    if warm_pool_config is None:
+        warm_pool_args = {'MinSize': 0, 'MaxGroupPreparedCapacity': prepared_capacity, 'PoolState': pool_state}
+    else:
+        warm_pool_args = dict((key, warm_pool_config[key]) for key in ('MinSize', 'MaxGroupPreparedCapacity', 'PoolState', 'InstanceReusePolicy') if key in warm_pool_config)
+    try:
+        asg_client.put_warm_pool(AutoScalingGroupName=autoscaling_group_name, **warm_pool_args)
+    except ClientError as err:
+        logger("Boto3 autoscaling put_warm_pool failed  Error: %s   Exiting script" % err, "critical")
+        printstring = "Boto3 autoscaling put_warm_pool failed  Error: %s   Exiting script" % err
+        print("{0}".format(colored(printstring, 'red')))
+        quit(2)
+    print("Warm pool for ASG %s set back to MinSize %s" % (autoscaling_group_name, warm_pool_args.get('MinSize', 0)))
+
+
+def run_capacity_ramp(autoscaling_group_name, ramp, max_setting):
+    """ Apply each (min, desired) step, waiting for InService instances and wait_seconds in between """
+    for step, (step_min, step_desired) in enumerate(ramp, 1):
+        print("Step %s/%s: setting Min=%s Max=%s Desired=%s" % (step, len(ramp), step_min, max_setting, step_desired))
+        logger("Step %s/%s: setting Min=%s Max=%s Desired=%s on ASG '%s'" % (step, len(ramp), step_min, max_setting, step_desired, autoscaling_group_name), "info")
+        update_asg_settings(autoscaling_group_name, step_min, max_setting, step_desired)
+        wait_for_in_service(autoscaling_group_name, step_desired)
+        if step < len(ramp):
+            print("Waiting %s seconds before next step" % wait_seconds)
+            time.sleep(wait_seconds)
+
+def get_snapshot_file(autoscaling_group_name):
+    return os.path.join(snapshot_dir, "%s_%s.json" % (aws_region, autoscaling_group_name))
+
+
+def save_snapshot(autoscaling_group_name, min_setting, max_setting, desired_setting, suspended_procs):
+    """ Save the pre-scale ASG settings, an existing snapshot is kept since it holds the original settings """
+    snapshot_file = get_snapshot_file(autoscaling_group_name)
+    if os.path.isfile(snapshot_file):
+        printstring = "Snapshot '%s' already exists (not yet restored), keeping the original pre-scale settings" % snapshot_file
+        print("{0}".format(colored(printstring, 'yellow')))
+        return
+    if not os.path.isdir(snapshot_dir):
+        os.makedirs(snapshot_dir)
+    instances = get_asg_instances(autoscaling_group_name)
+    snapshot = {
+        'AutoScalingGroupName': autoscaling_group_name,
+        'Region': aws_region,
+        'Timestamp': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'MinSize': min_setting,
+        'MaxSize': max_setting,
+        'DesiredCapacity': desired_setting,
+        'SuspendedProcesses': [process['ProcessName'] for process in suspended_procs],
+        'Instances': dict((instance['InstanceId'], instance.get('ProtectedFromScaleIn', False)) for instance in instances),
+        'WarmPoolConfiguration': get_warm_pool_configuration(autoscaling_group_name),
+    }
+    with open(snapshot_file, 'w') as f:
+        json.dump(snapshot, f, indent=2, sort_keys=True)
+    print("Saved pre-scale settings for ASG %s to %s" % (autoscaling_group_name, snapshot_file))
+    logger("Saved snapshot for ASG '%s' to '%s': %s" % (autoscaling_group_name, snapshot_file, snapshot), "info")
+
+
+def load_snapshot(autoscaling_group_name):
+    snapshot_file = get_snapshot_file(autoscaling_group_name)
+    try:
+        with open(snapshot_file) as f:
+            return json.load(f)
+    except (IOError, ValueError) as err:
+        logger("Unable to read snapshot '%s'  Error: %s" % (snapshot_file, err), "critical")
+        printstring = "Unable to read snapshot '%s' for ASG %s  Error: %s" % (snapshot_file, autoscaling_group_name, err)
+        print("{0}".format(colored(printstring, 'red')))
+        return None
+
+
+def set_scale_in_protection(autoscaling_group_name, instance_ids, protected):
+    for i in range(0, len(instance_ids), protection_batch_size):
+        try:
+            asg_client.set_instance_protection(AutoScalingGroupName=autoscaling_group_name,
+                                               InstanceIds=instance_ids[i:i + protection_batch_size],
+                                               ProtectedFromScaleIn=protected)
+        except ClientError as err:
+            logger("Boto3 autoscaling set_instance_protection failed  Error: %s   Exiting script" % err, "critical")
+            printstring = "Boto3 autoscaling set_instance_protection failed  Error: %s   Exiting script" % err
+            print("{0}".format(colored(printstring, 'red')))
+            quit(2)
+
+
+def wait_for_scale_in(autoscaling_group_name, desired_setting):
+    """ Poll the ASG until no more than desired_setting instances remain (Terminating instances not counted) """
+    wait_start = time.time()
+    while True:
+        remaining = 0
+        for instance in get_asg_instances(autoscaling_group_name):
+            if not instance['LifecycleState'].startswith('Terminating'):
+                remaining += 1
+        if remaining <= desired_setting:
+            print("%s: %s/%s instances remaining after %ds" % (autoscaling_group_name, remaining, desired_setting, time.time() - wait_start))
+            return
+        if time.time() - wait_start > wait_timeout_seconds:
+            logger("Timed out after %ds waiting for ASG '%s' to scale in to %s   Exiting script" % (wait_timeout_seconds, autoscaling_group_name, desired_setting), "critical")
+            printstring = "%s: timed out after %ds waiting to scale in to %s (%s remaining)   Exiting script" % (autoscaling_group_name, wait_timeout_seconds, desired_setting, remaining)
+            print("{0}".format(colored(printstring, 'red')))
+            quit(2)
+        print("%s: waiting for scale in: %s/%s instances remaining" % (autoscaling_group_name, remaining, desired_setting))
+        time.sleep(poll_seconds)
+
+
+def restore_asg(autoscaling_group_name, results):
+    """ Scale the ASG back down, in increments, to its snapshot settings """
+    results[autoscaling_group_name] = 'failed'
+    snapshot = load_snapshot(autoscaling_group_name)
+    if snapshot is None:
+        return
+    current_min, current_max, current_desired, current_suspended = get_asg_settings([autoscaling_group_name])
+
+    # Put the warm pool back first so scaled-in instances are terminated rather than returned to the pool
+    if snapshot['WarmPoolConfiguration'] is None:
+        if get_warm_pool_configuration(autoscaling_group_name) is not None:
+            try:
+                asg_client.delete_warm_pool(AutoScalingGroupName=autoscaling_group_name, ForceDelete=True)
+            except ClientError as err:
+                printstring = "%s: Boto3 autoscaling delete_warm_pool failed  Error: %s" % (autoscaling_group_name, err)
+                print("{0}".format(colored(printstring, 'red')))
+                return
+            print("%s: deleted warm pool" % autoscaling_group_name)
+    else:
+        warm_pool_config = snapshot['WarmPoolConfiguration']
+        warm_pool_args = dict((key, warm_pool_config[key]) for key in ('MinSize', 'MaxGroupPreparedCapacity', 'PoolState', 'InstanceReusePolicy') if key in warm_pool_config)
+        try:
+            asg_client.put_warm_pool(AutoScalingGroupName=autoscaling_group_name, **warm_pool_args)
+        except ClientError as err:
+            printstring = "%s: Boto3 autoscaling put_warm_pool failed  Error: %s" % (autoscaling_group_name, err)
+            print("{0}".format(colored(printstring, 'red')))
+            return
+        print("%s: restored warm pool settings" % autoscaling_group_name)
+
+    protected_ids = []
+    if drain_set is True:
+        # Protect the instances that were there before the doubling so scale in removes the added ones
+        current_ids = [instance['InstanceId'] for instance in get_asg_instances(autoscaling_group_name)]
+        protected_ids = [instance_id for instance_id in current_ids
+                         if instance_id in snapshot['Instances'] and snapshot['Instances'][instance_id] is False]
+
+    # The protection is removed again however the ramp ends, including quit() on a failed step
+    try:
+        if len(protected_ids) > 0:
+            set_scale_in_protection(autoscaling_group_name, protected_ids, True)
+            print("%s: protected %s pre-scale instances from scale in" % (autoscaling_group_name, len(protected_ids)))
+
+        ramp = get_ramp_steps(current_min, current_desired, snapshot['MinSize'], snapshot['DesiredCapacity'], ramp_steps)
+        for step, (step_min, step_desired) in enumerate(ramp, 1):
+            # Max can only drop to the snapshot value once Desired is back within it
+            max_setting = snapshot['MaxSize'] if step == len(ramp) else max(current_max, snapshot['MaxSize'])
+            print("%s: step %s/%s: setting Min=%s Max=%s Desired=%s" % (autoscaling_group_name, step, len(ramp), step_min, max_setting, step_desired))
+            logger("Restore step %s/%s: setting Min=%s Max=%s Desired=%s on ASG '%s'" % (step, len(ramp), step_min, max_setting, step_desired, autoscaling_group_name), "info")
+            update_asg_settings(autoscaling_group_name, step_min, max_setting, step_desired)
+            wait_for_scale_in(autoscaling_group_name, step_desired)
+            if step < len(ramp):
+                time.sleep(wait_seconds)
+    finally:
+        if len(protected_ids) > 0:
+            set_scale_in_protection(autoscaling_group_name, protected_ids, False)
+            print("%s: removed scale in protection from %s pre-scale instances" % (autoscaling_group_name, len(protected_ids)))
+
+    # Resume processes that were suspended for the doubling
+    resume_procs = [process['ProcessName'] for process in current_suspended if process['ProcessName'] not in snapshot['SuspendedProcesses']]
+    if len(resume_procs) > 0:
+        try:
+            asg_client.resume_processes(AutoScalingGroupName=autoscaling_group_name, ScalingProcesses=resume_procs)
+        except ClientError as err:
+            printstring = "%s: Boto3 autoscaling resume_processes failed  Error: %s" % (autoscaling_group_name, err)
+            print("{0}".format(colored(printstring, 'red')))
+            return
+        print("%s: resumed processes %s" % (autoscaling_group_name, ", ".join(resume_procs)))
+
+    os.remove(get_snapshot_file(autoscaling_group_name))
+    results[autoscaling_group_name] = 'restored'
+
+
+if restore_mode is True:
+    restore_results = {}
+    restore_threads = []
+    for restore_asg_name in [name.strip() for name in asg_name.split(",") if name.strip() != ""]:
+        thread = threading.Thread(target=restore_asg, args=(restore_asg_name, restore_results))
+        thread.start()
+        restore_threads.append(thread)
+    for thread in restore_threads:
+        thread.join()
+    print(" ")
+    exit_code = 0
+    for restore_asg_name in sorted(restore_results):
+        if restore_results[restore_asg_name] == 'restored':
+            print("{0}".format(colored("%s: restored" % restore_asg_name, 'green')))
+        else:
+            print("{0}".format(colored("%s: restore failed" % restore_asg_name, 'red')))
+            exit_code = 2
+    quit(exit_code)
+
 print("Getting current settings for ASG: %s" % asg_name)
 current_asg_min, current_asg_max, current_asg_desired, current_suspended_procs = get_asg_settings(source_asg)
 
 double_asg_min = current_asg_min * 2
 double_asg_desired = current_asg_desired * 2
-
-
-#update_asg_settings(asg_name, 2, 4, 2)
-#get_asg_settings(source_asg)
+double_asg_max = max(current_asg_max, double_asg_desired)
+ramp = get_ramp_steps(current_asg_min, current_asg_desired, double_asg_min, double_asg_desired, ramp_steps)
+
+if plan_only is True:
+    print("Planning capacity ramp for ASG: %s (no changes will be made)" % asg_name)
+    plan_capacity_ramp(asg_name, ramp, current_asg_desired, double_asg_max, current_asg_max)
+    quit(0)
+
+save_snapshot(asg_name, current_asg_min, current_asg_max, current_asg_desired, current_suspended_procs)
+suspend_asg_process(asg_name, suspend_process)
+
+if double_asg_max > current_asg_max:
+    # Raise Max first so both the warm pool and the ramp have room for the doubled Desired
+    print("Raising Max from %s to %s for ASG: %s" % (current_asg_max, double_asg_max, asg_name))
+    update_asg_settings(asg_name, current_asg_min, double_asg_max, current_asg_desired)
+
+if warm_pool is True:
+    # Warm pool size is MaxGroupPreparedCapacity minus Desired, so prepare exactly the doubled Desired
+    current_warm_pool_config = get_warm_pool_configuration(asg_name)
+    provision_warm_pool(asg_name, double_asg_desired - current_asg_desired, double_asg_desired, warm_pool_state)
+
+run_capacity_ramp(asg_name, ramp, double_asg_max)
+if warm_pool is True:
+    # With MinSize left at warm_size the pool would launch a second, unused set of warm instances
+    shrink_warm_pool(asg_name, current_warm_pool_config, double_asg_desired, warm_pool_state)
+print("Finished doubling ASG: %s" % asg_name)
+get_asg_settings(source_asg)
 quit(0)
 
@@ -6,12 +6,39 @@
 #   Input arg1: aws region
 #   Input arg2: cognito pool id
 #   Input arg3: file name to write to
+#
+#   --parallel splits the pool into partitions by email prefix (Filter 'email ^= "a"', ...)
+#   and pages the partitions concurrently, partitions with more than one page of users
+#   are split one character deeper (up to --max-prefix-length)
+#
+#   Mismatches are written to the file as each page is processed, --csv writes
+#   username, ideal username and email columns instead of only the email
+#
+#   Progress (the PaginationToken of every partition) is checkpointed each time the
+#   output file is flushed, --resume continues an interrupted scan from the checkpoint.
+#   The checkpoint file holds the progress when the run started followed by a journal
+#   line per page and split, so a checkpoint costs the same however many partitions are left
+#
+#   list_users calls start at --rate per second and speed up until Cognito throttles,
+#   a throttled call halves the rate and is retried with the same PaginationToken
+#
+#   Username, email and UserLastModifiedDate of every user are kept in a local SQLite
+#   snapshot, --diff <file> writes only the mismatches that are new or changed since the
+#   last snapshot and the users that were fixed (or removed) since
 
 import boto3
 from botocore.config import Config
+from botocore.exceptions import ClientError, EndpointConnectionError, ConnectionClosedError, ConnectTimeoutError, ReadTimeoutError
+from concurrent.futures import ThreadPoolExecutor
 import argparse
+import csv
+import json
 import os
 import re
+import sqlite3
+import string
+import threading
+import time
 
 # Check Python version
 req_version = (3, 9)
@@ -23,16 +50,62 @@ if not cur_version >= req_version:
 
 script_name = os.path.basename(__file__)
 
+# Email prefix partitions are built from these characters (Cognito prefix filters are case sensitive),
+#   a split partition also gets a child ending in '@' for the emails whose local part is the prefix.
+#   Users whose email has any other character within its first --max-prefix-length characters
+#   are not covered by a --parallel scan
+partition_characters = string.ascii_lowercase + string.ascii_uppercase + string.digits + "!#$%&'*+-/=?^_`{|}~."
+split_characters = partition_characters + '@'
+
+# Only the email is checked, so list_users is asked for nothing else (Username is always returned),
+#   keeping each page of 60 users small however many attributes the pool has
+user_attributes_to_get = ['email']
+
+# Output file write buffer size in bytes
+write_buffer_size = 65536
+
+# list_users rate control: successful calls raise the rate by about rate_increase calls/s every second,
+#   a throttled call multiplies it by rate_decrease (at most once per rate_decrease_seconds, as
+#   concurrent calls are throttled together), and a page throttled max_throttle_retries times in a row fails
+rate_increase = 1
+rate_decrease = 0.5
+rate_decrease_seconds = 1
+min_rate = 0.5
+max_throttle_retries = 20
+throttle_error_codes = ['TooManyRequestsException', 'ThrottlingException']
+
+# Server errors (5xx) and dropped connections on list_users are retried up to max_transient_retries
+#   times per page, waiting transient_backoff_seconds and doubling the wait on each retry
+max_transient_retries = 5
+transient_backoff_seconds = 1
+transient_connection_errors = (EndpointConnectionError, ConnectionClosedError, ConnectTimeoutError, ReadTimeoutError)
+
+# Bump when the checkpoint format changes so older checkpoints are not resumed from
+checkpoint_version = 3
+
 # Get cli arguments
 parser = argparse.ArgumentParser(description="Loop over users in Cognito and write to Text file those who have a mismatch between their username and emails")
 parser.add_argument("region", help="AWS Region", type=str)
 parser.add_argument("cognitopool", help="AWS Cognito User Pool ID", type=str)
 parser.add_argument("file", help="File name as output", type=str)
 parser.add_argument("--awsprofile", help="AWS Profile name", type=str)
+parser.add_argument("--parallel", help="Scan email prefix partitions of the pool concurrently", action="store_true")
+parser.add_argument("--workers", help="Number of partitions paged at the same time with --parallel (default: 8)", type=int, default=8)
+parser.add_argument("--rate", help="Starting list_users calls per second across all partitions (default: 10)", type=float, default=10)
+parser.add_argument("--max-rate", help="Highest list_users calls per second the rate is raised to (default: 50)", type=float, default=50)
+parser.add_argument("--max-prefix-length", help="Longest email prefix a hot partition is split down to (default: 2)", type=int, choices=[1, 2, 3], default=2)
+parser.add_argument("--csv", help="Write username, ideal username and email CSV columns instead of only the email", action="store_true")
+parser.add_argument("--flush-interval", help="Seconds between flushes and checkpoints of the output file (default: 0, after every page)", type=float, default=0)
+parser.add_argument("--checkpoint-file", help="Scan checkpoint file (default: <file>.checkpoint)", type=str)
+parser.add_argument("--resume", help="Continue an interrupted scan from its checkpoint", action="store_true")
+parser.add_argument("--snapshot-file", help="SQLite snapshot of the last scan (default: ~/.cache/cognito-list-username-errors/<cognitopool>.sqlite)", type=str)
+parser.add_argument("--diff", help="Also write the mismatches that are new/changed and the users fixed/removed since the last snapshot to this file", type=str)
 args = parser.parse_args()
 region = args.region
 cognito_pool = args.cognitopool
 output_file = args.file
+checkpoint_file = args.checkpoint_file or f'{output_file}.checkpoint'
+snapshot_file = args.snapshot_file or os.path.join(os.path.expanduser('~'), '.cache', 'cognito-list-username-errors', f'{cognito_pool}.sqlite')
 if args.awsprofile:
     aws_profile = args.awsprofile
 
@@ -42,6 +115,14 @@ print(f'Cognito Pool ID: {cognito_pool}')
 print(f'Output File Name: {output_file}')
 if args.awsprofile:
     print(f'Using AWS Profile: {aws_profile}')
+if args.parallel:
+    print(f'Parallel scan: {args.workers} workers, prefixes up to {args.max_prefix_length} characters')
+print(f'list_users rate: {args.rate} calls/s, up to {args.max_rate} calls/s')
+if args.resume:
+    print(f'Resuming from checkpoint: {checkpoint_file}')
+print(f'Snapshot File Name: {snapshot_file}')
+if args.diff:
+    print(f'Diff File Name: {args.diff}')
 
 # Use an AWS profile if specified
 if args.awsprofile:
@@ -57,83 +138,480 @@ my_config = Config(
     retries = {
         'max_attempts': 3,
         'mode': 'standard'
-    }
+    },
+    max_pool_connections = args.workers
 )
 
+# list_users gets its own client without botocore retries, so every throttled call reaches the
+#   rate controller (list_users_page retries server and connection errors itself)
+list_users_config = my_config.merge(Config(
+    retries = {
+        'max_attempts': 0,
+        'mode': 'standard'
+    }
+))
+
 # Make a boto3 connection to Cognito IDP
 try:
     client = boto3.client('cognito-idp', config=my_config)
+    list_users_client = boto3.client('cognito-idp', config=list_users_config)
 except Exception as error:
     print(f'Error: {error}')
     exit(2)
 
-# Keep counts
-username_mismatch_counts = 0
-username_mismatch_list = []
-total_users = 1
-pagination_count = 0
-pagination_token = ""
-next_pagination_token = ""
-
-# While loop to list_users call with pagination
-# AWS allows a maximum of 60 users per call
-while next_pagination_token is not None:
-    if pagination_token == "":
-        pagination_count += 1
-        try:
-            response = client.list_users(
-                UserPoolId=cognito_pool,
-                # AttributesToGet=[
-                #     'email', 'email_verified', 'phone_number', 'phone_number_verified', 'name', 'family_name'
-                # ],
-                Limit=60
-            )
-        except Exception as error:
-            print(f'Error: {error}')
-            exit(2)
+
+class AimdRateLimiter:
+    """ Token bucket whose rate is raised additively while calls succeed and cut multiplicatively
+        when they are throttled, so it settles just under the account's list_users quota """
+
+    def __init__(self, rate, max_rate):
+        self.rate = min(rate, max_rate)
+        self.max_rate = max_rate
+        self.tokens = 1
+        self.updated = time.monotonic()
+        self.decreased = 0
+        self.calls = 0
+        self.throttles = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(max(self.rate, 1), self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def succeeded(self):
+        with self.lock:
+            self.calls += 1
+            self.rate = min(self.max_rate, self.rate + rate_increase / self.rate)
+
+    def throttled(self):
+        with self.lock:
+            self.throttles += 1
+            now = time.monotonic()
+            if now - self.decreased >= rate_decrease_seconds:
+                self.rate = max(min_rate, self.rate * rate_decrease)
+                self.decreased = now
+            # Drop any saved up burst so the retries go out at the new rate
+            self.tokens = min(self.tokens, 0)
+
+
+def new_checkpoint():
+    """ Progress of a scan that has not started, the unfiltered scan is the partition with prefix '' """
+    return {
+        'CheckpointVersion': checkpoint_version,
+        'UserPoolId': cognito_pool,
+        'Parallel': args.parallel,
+        'MaxPrefixLength': args.max_prefix_length,
+        'Csv': args.csv,
+        'SnapshotFile': snapshot_file,
+        # Partitions still to scan, prefix -> PaginationToken of the next page and users scanned so far
+        'Partitions': {prefix: {'PaginationToken': None, 'Users': 0} for prefix in (partition_characters if args.parallel else [''])},
+        'FinishedPartitions': 0,
+        'FinishedUsers': 0,
+        'OutputSize': 0,
+        'Mismatches': 0
+    }
+
+
+def apply_checkpoint_entry(checkpoint, entry):
+    """ Apply a journal entry, a page of a partition or a split, to the checkpoint """
+    if 'Split' in entry:
+        # The children of a split are derived, they always start on their first page
+        del checkpoint['Partitions'][entry['Split']]
+        for character in split_characters:
+            checkpoint['Partitions'][entry['Split'] + character] = {'PaginationToken': None, 'Users': 0}
+    elif entry['PaginationToken']:
+        checkpoint['Partitions'][entry['Page']] = {'PaginationToken': entry['PaginationToken'], 'Users': entry['Users']}
     else:
-        pagination_count += 1
+        del checkpoint['Partitions'][entry['Page']]
+        checkpoint['FinishedPartitions'] += 1
+        checkpoint['FinishedUsers'] += entry['Users']
+
+
+def load_checkpoint():
+    """ Return the checkpoint to resume from, or raise ValueError if it does not match this scan """
+    with open(checkpoint_file) as file:
+        lines = file.readlines()
+    if len(lines) == 0:
+        raise ValueError(f'{checkpoint_file} is empty')
+    checkpoint = json.loads(lines[0])
+    if checkpoint.get('CheckpointVersion') != checkpoint_version:
+        raise ValueError(f'{checkpoint_file} was written by an older version of {script_name}')
+    for key, value in (('UserPoolId', cognito_pool), ('Parallel', args.parallel), ('MaxPrefixLength', args.max_prefix_length), ('Csv', args.csv), ('SnapshotFile', snapshot_file)):
+        if checkpoint[key] != value:
+            raise ValueError(f'{checkpoint_file} is for a scan with {key} {checkpoint[key]}, not {value}')
+    # Replay the journal up to its last flush, the pages after it were not flushed to the output file
+    entries = []
+    for line in lines[1:]:
         try:
-            response = client.list_users(
-                UserPoolId=cognito_pool,
-                # AttributesToGet=[
-                #     'email', 'email_verified', 'phone_number', 'phone_number_verified', 'name', 'family_name'
-                # ],
-                Limit=60,
-                PaginationToken=pagination_token
+            entry = json.loads(line)
+        except ValueError:
+            # Cut short by an interrupted run
+            break
+        if 'OutputSize' in entry:
+            for page_or_split in entries:
+                apply_checkpoint_entry(checkpoint, page_or_split)
+            entries = []
+            checkpoint['OutputSize'] = entry['OutputSize']
+            checkpoint['Mismatches'] = entry['Mismatches']
+        else:
+            entries.append(entry)
+    return checkpoint
+
+
+def save_checkpoint(checkpoint):
+    # Write then rename so an interrupted run never leaves a partial checkpoint behind
+    with open(f'{checkpoint_file}.tmp', 'w') as file:
+        file.write(json.dumps(checkpoint) + '\n')
+    os.replace(f'{checkpoint_file}.tmp', checkpoint_file)
+
+
+def open_snapshot(resume):
+    """ Open the snapshot database, users holds the last finished scan and scan_users the
+        scan in progress (kept when resuming, emptied when starting over) """
+    os.makedirs(os.path.dirname(os.path.abspath(snapshot_file)), exist_ok=True)
+    # Pages are written from the partition worker threads, always under the writer lock
+    snapshot = sqlite3.connect(snapshot_file, check_same_thread=False)
+    snapshot.execute('PRAGMA journal_mode=WAL')
+    snapshot.execute('PRAGMA synchronous=NORMAL')
+    for table in ('users', 'scan_users'):
+        snapshot.execute(f'CREATE TABLE IF NOT EXISTS {table} (username TEXT PRIMARY KEY, email TEXT, last_modified TEXT, mismatch INTEGER) WITHOUT ROWID')
+    snapshot.execute('CREATE TABLE IF NOT EXISTS scans (finished TEXT, users INTEGER, mismatches INTEGER)')
+    if not resume:
+        snapshot.execute('DELETE FROM scan_users')
+    snapshot.commit()
+    return snapshot
+
+
+def get_snapshot_diff(snapshot):
+    """ Return (status, username, email) rows for mismatches that are new or changed since the last
+        snapshot, and for users that were mismatched then and are now fixed or removed. Usernames
+        cannot be changed, so a mismatched user replaced by a matching user with the same email is fixed """
+    snapshot.execute('CREATE INDEX IF NOT EXISTS scan_users_email ON scan_users (email)')
+    return snapshot.execute('''
+        SELECT CASE WHEN users.username IS NULL OR users.mismatch = 0 THEN 'new' ELSE 'changed' END, scan_users.username, scan_users.email
+        FROM scan_users LEFT JOIN users ON users.username = scan_users.username
+        WHERE scan_users.mismatch = 1 AND (users.username IS NULL OR users.mismatch = 0
+            OR users.email != scan_users.email OR users.last_modified != scan_users.last_modified)
+        UNION ALL
+        SELECT CASE WHEN scan_users.username IS NOT NULL OR EXISTS (
+            SELECT 1 FROM scan_users AS replaced WHERE replaced.email = users.email AND replaced.mismatch = 0
+        ) THEN 'fixed' ELSE 'removed' END, users.username, users.email
+        FROM users LEFT JOIN scan_users ON scan_users.username = users.username
+        WHERE users.mismatch = 1 AND (scan_users.username IS NULL OR scan_users.mismatch = 0)
+        ORDER BY 1, 2
+    ''')
+
+
+def write_snapshot_diff(snapshot, file_name, csv_columns):
+    """ Write the diff against the last snapshot and return {status: count} """
+    counts = {'new': 0, 'changed': 0, 'fixed': 0, 'removed': 0}
+    with open(file_name, 'w', buffering=write_buffer_size, newline='') as file:
+        csv_writer = csv.writer(file) if csv_columns else None
+        if csv_writer is not None:
+            csv_writer.writerow(['status', 'username', 'ideal_username', 'email'])
+        for status, username, email in get_snapshot_diff(snapshot):
+            counts[status] += 1
+            if csv_writer is not None:
+                csv_writer.writerow([status, username, re.sub("[@.]", "|", email), email])
+            else:
+                file.write(f'{status}\t{email}\n')
+    return counts
+
+
+def replace_snapshot(snapshot, user_count, mismatch_count):
+    """ Make the finished scan the snapshot the next scan is compared with """
+    with snapshot:
+        snapshot.execute('DROP INDEX IF EXISTS scan_users_email')
+        snapshot.execute('DROP TABLE users')
+        snapshot.execute('ALTER TABLE scan_users RENAME TO users')
+        snapshot.execute('CREATE TABLE scan_users (username TEXT PRIMARY KEY, email TEXT, last_modified TEXT, mismatch INTEGER) WITHOUT ROWID')
+        snapshot.execute('INSERT INTO scans VALUES (?, ?, ?)', (time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), user_count, mismatch_count))
+
+
+class MismatchWriter:
+    """ Write mismatched users to the output file as they are found, buffered and flushed every
+        flush_interval seconds, and every user to the snapshot. Each page and split is journaled to the
+        checkpoint file, and each flush also commits the snapshot and journals the output file size, so
+        on resume the file is cut back to exactly the pages the checkpoint has recorded (snapshot rows of
+        pages fetched again are replaced) """
+
+    def __init__(self, file_name, csv_columns, flush_interval, checkpoint, snapshot):
+        if checkpoint['OutputSize'] > 0:
+            # Drop anything written after the last checkpoint, those pages are fetched again
+            os.truncate(file_name, checkpoint['OutputSize'])
+            self.file = open(file_name, 'a', buffering=write_buffer_size, newline='')
+        else:
+            self.file = open(file_name, 'w', buffering=write_buffer_size, newline='')
+        self.csv_writer = csv.writer(self.file) if csv_columns else None
+        self.flush_interval = flush_interval
+        self.flushed = time.monotonic()
+        self.checkpoint = checkpoint
+        self.snapshot = snapshot
+        self.count = checkpoint['Mismatches']
+        self.lock = threading.Lock()
+        if self.csv_writer is not None and checkpoint['OutputSize'] == 0:
+            self.csv_writer.writerow(['username', 'ideal_username', 'email'])
+        # Start the journal from the progress so far, dropping the journal a resumed run left behind
+        save_checkpoint(checkpoint)
+        self.journal = open(checkpoint_file, 'a', buffering=write_buffer_size)
+
+    def write_page(self, prefix, pagination_token, user_count, users):
+        """ Write one page of users and record the partition's progress, a partition with
+            no pagination token left is finished """
+        mismatches = [(username, ideal_username, email) for username, ideal_username, email, last_modified in users if ideal_username != username]
+        entry = {'Page': prefix, 'PaginationToken': pagination_token, 'Users': user_count}
+        journal_line = json.dumps(entry) + '\n'
+        with self.lock:
+            for username, ideal_username, email in mismatches:
+                if self.csv_writer is not None:
+                    self.csv_writer.writerow([username, ideal_username, email])
+                else:
+                    self.file.write(email+'\n')
+            self.count += len(mismatches)
+            self.snapshot.executemany(
+                'INSERT OR REPLACE INTO scan_users VALUES (?, ?, ?, ?)',
+                [(username, email, last_modified, int(ideal_username != username)) for username, ideal_username, email, last_modified in users]
             )
-        except Exception as error:
-            print(f'Error: {error}')
-            exit(2)
-    # Loop through all users
-    for user in response['Users']:
-        total_users += 1
+            apply_checkpoint_entry(self.checkpoint, entry)
+            self.journal.write(journal_line)
+            if time.monotonic() - self.flushed >= self.flush_interval:
+                self.flush()
+
+    def split(self, prefix):
+        """ Replace a partition with its child partitions """
+        entry = {'Split': prefix}
+        journal_line = json.dumps(entry) + '\n'
+        with self.lock:
+            apply_checkpoint_entry(self.checkpoint, entry)
+            self.journal.write(journal_line)
+
+    def flush(self):
+        self.file.flush()
+        self.snapshot.commit()
+        self.checkpoint['OutputSize'] = self.file.tell()
+        self.checkpoint['Mismatches'] = self.count
+        # Journal entries up to here are in effect on resume
+        self.journal.write(f'{{"OutputSize": {self.checkpoint["OutputSize"]}, "Mismatches": {self.count}}}\n')
+        self.journal.flush()
+        self.flushed = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.file.close()
+            self.journal.close()
+
+
+# One limiter shared by every partition, the list_users quota is per account
+rate_limiter = AimdRateLimiter(args.rate, args.max_rate)
+
+# Set when a parallel scan fails, partitions being paged stop before their next page
+stop_scan = threading.Event()
+
+
+def list_users_page(filter_expression, pagination_token):
+    """ One list_users call, AWS allows a maximum of 60 users per call """
+    request = {
+        'UserPoolId': cognito_pool,
+        'AttributesToGet': user_attributes_to_get,
+        'Limit': 60
+    }
+    if filter_expression is not None:
+        request['Filter'] = filter_expression
+    if pagination_token:
+        request['PaginationToken'] = pagination_token
+    throttle_retries = 0
+    transient_retries = 0
+    while True:
+        rate_limiter.acquire()
+        try:
+            response = list_users_client.list_users(**request)
+        except ClientError as error:
+            if error.response['Error']['Code'] in throttle_error_codes and throttle_retries < max_throttle_retries:
+                # Slow down and ask for the same page again
+                throttle_retries += 1
+                rate_limiter.throttled()
+                continue
+            if error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) < 500 or transient_retries == max_transient_retries:
+                raise
+            transient_retries += 1
+            time.sleep(transient_backoff_seconds * 2 ** (transient_retries - 1))
+            continue
+        except transient_connection_errors:
+            if transient_retries == max_transient_retries:
+                raise
+            transient_retries += 1
+            time.sleep(transient_backoff_seconds * 2 ** (transient_retries - 1))
+            continue
+        rate_limiter.succeeded()
+        return response
+
+
+def check_users(users):
+    """ Return (username, ideal username, email, last modified date) for every user, the username
+        is mismatched when it is not the ideal username """
+    checked_users = []
+    for user in users:
         user_attributes = { attr['Name']:attr['Value'] for attr in user['Attributes'] }
         ideal_username = re.sub("[@.]", "|", user_attributes['email'])
         actual_username = user['Username']
-        if ideal_username != actual_username:
-            username_mismatch_counts += 1
-            username_mismatch_list.append(user_attributes['email'])
-    # Check for pagination token returned in the response and go again if it exists
+        checked_users.append((actual_username, ideal_username, user_attributes['email'], str(user.get('UserLastModifiedDate'))))
+    return checked_users
+
+
+def scan_partition(prefix, pagination_token, user_count):
+    """ Page through the users whose email starts with prefix (all users if prefix is ''), from
+        pagination_token on, writing mismatches out page by page, and return the child prefixes if the
+        partition was split. A partition that has more than one page of users is split into one
+        character longer prefixes instead of being paged """
+    filter_expression = f'email ^= "{prefix}"' if prefix else None
+    while True:
+        if stop_scan.is_set():
+            # The partition's progress so far is in the checkpoint
+            return []
+        response = list_users_page(filter_expression, pagination_token)
+        next_pagination_token = response.get('PaginationToken')
+        if prefix and next_pagination_token and pagination_token is None and len(prefix) < args.max_prefix_length:
+            # A longer prefix can only be followed by a local part character or by the '@' ending the local part
+            writer.split(prefix)
+            return [f'{prefix}{character}' for character in split_characters]
+        user_count += len(response['Users'])
+        pagination_token = next_pagination_token
+        writer.write_page(prefix, pagination_token, user_count, check_users(response['Users']))
+        # Check for pagination token returned in the response and go again if it exists
+        if not pagination_token:
+            return []
+
+
+def scan_parallel(partitions):
+    """ Scan the email prefix partitions on a pool of workers, splitting hot partitions as they are found """
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+    lock = threading.Lock()
+    # Partitions submitted and not done yet, starting at 1 until every partition passed in is submitted
+    outstanding = 1
+    finished = threading.Event()
+    errors = []
+
+    def submit(prefix, pagination_token, user_count):
+        nonlocal outstanding
+        with lock:
+            outstanding += 1
+        executor.submit(scan_partition, prefix, pagination_token, user_count).add_done_callback(partition_done)
+
+    def release():
+        nonlocal outstanding
+        with lock:
+            outstanding -= 1
+            if outstanding == 0:
+                finished.set()
+
+    def partition_done(future):
+        # Submit the children of a split partition as soon as it is done
+        if future.cancelled():
+            pass
+        elif future.exception() is not None:
+            errors.append(future.exception())
+            stop_scan.set()
+        elif not stop_scan.is_set():
+            try:
+                for child in future.result():
+                    submit(child, None, 0)
+            except RuntimeError:
+                # The executor was shut down by an interrupt, the children are in the checkpoint
+                pass
+        release()
+
     try:
-        if len(response['PaginationToken']) > 0:    
-            pagination_token = response['PaginationToken']
-        else:
-            next_pagination_token = None
-    except KeyError:
-        next_pagination_token = None
+        for prefix, partition in partitions.items():
+            submit(prefix, partition['PaginationToken'], partition['Users'])
+        release()
+        finished.wait()
+    except BaseException:
+        stop_scan.set()
+        raise
+    finally:
+        # On errors stop at once rather than scanning every queued partition first
+        executor.shutdown(wait=True, cancel_futures=True)
+    if len(errors) > 0:
+        raise errors[0]
+
+
+try:
+    checkpoint = load_checkpoint() if args.resume else new_checkpoint()
+    snapshot = open_snapshot(args.resume)
+    writer = MismatchWriter(output_file, args.csv, args.flush_interval, checkpoint, snapshot)
+except FileNotFoundError as error:
+    print(f'Error: nothing to resume, {error}')
+    exit(2)
+except (OSError, ValueError, sqlite3.Error) as error:
+    print(f'Error: {error}')
+    exit(2)
+
+# Users already scanned by the run a resumed checkpoint came from
+resumed_users = checkpoint['FinishedUsers'] + sum(partition['Users'] for partition in checkpoint['Partitions'].values())
+scan_started = time.monotonic()
+
+# Scan all users, either as one sequential list_users pagination or as concurrent partitions
+try:
+    if args.parallel:
+        scan_parallel(dict(checkpoint['Partitions']))
+    else:
+        partition = checkpoint['Partitions']['']
+        scan_partition('', partition['PaginationToken'], partition['Users'])
+except Exception as error:
+    print(f'Error: {error}')
+    print(f'Wrote {writer.count} mismatched users found so far to {output_file}, run again with --resume to continue')
+    exit(2)
+finally:
+    writer.close()
+os.remove(checkpoint_file)
+scan_seconds = time.monotonic() - scan_started
+total_users = checkpoint['FinishedUsers']
+username_mismatch_counts = writer.count
+
+if args.parallel:
+    print(f'Scanned {checkpoint["FinishedPartitions"]} partitions')
+    # Users with no email, or with a character outside split_characters early in their email, are in no partition
+    try:
+        estimated_users = client.describe_user_pool(UserPoolId=cognito_pool)['UserPool'].get('EstimatedNumberOfUsers', 0)
+    except Exception as error:
+        print(f'Error: {error}')
+        exit(2)
+    if total_users < estimated_users:
+        print(f'Warning: scanned {total_users} users but the pool has about {estimated_users}, users without an email or with an email that has an unusual character in its first {args.max_prefix_length} characters were not scanned')
+
+# Compare with the last snapshot, then keep this scan as the snapshot for the next one
+try:
+    if args.diff:
+        diff_counts = write_snapshot_diff(snapshot, args.diff, args.csv)
+    previous_scan = snapshot.execute('SELECT finished FROM scans ORDER BY finished DESC LIMIT 1').fetchone()
+    replace_snapshot(snapshot, total_users, username_mismatch_counts)
+    snapshot.close()
+except (OSError, sqlite3.Error) as error:
+    print(f'Error: {error}')
+    exit(2)
+if args.diff:
+    if previous_scan is None:
+        print('No previous snapshot, every mismatch is reported as new')
+    else:
+        print(f'Changes since the snapshot of {previous_scan[0]}:')
+    print(f'New mismatches: {diff_counts["new"]}, changed: {diff_counts["changed"]}, fixed: {diff_counts["fixed"]}, removed users: {diff_counts["removed"]}')
 
 # Print out totals
 print(f'Total users: {total_users}')
 print(f'Username mismatch count: {username_mismatch_counts}')
+print(f'Scanned {total_users - resumed_users} users in {scan_seconds:.1f}s ({(total_users - resumed_users) / max(scan_seconds, 0.001):.1f} users/s)')
+print(f'list_users calls: {rate_limiter.calls}, throttled: {rate_limiter.throttles}, final rate: {rate_limiter.rate:.1f} calls/s')
 
 print('')
-if len(username_mismatch_list) == 0:
+if username_mismatch_counts == 0:
     print('No mismatched users found')
-    exit(0)
-
-# Loop over dictionary to create a csv file with items in a specified order
-with open(output_file, 'w') as file:
-    for email in username_mismatch_list:
-        file.write(email+'\n')
-file.close()
+exit(0)